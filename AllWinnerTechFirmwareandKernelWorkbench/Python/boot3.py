@@ -8,12 +8,28 @@ import struct
 import binascii
 import hashlib
 import zlib
+import mmap
+import io
+import re
+import time
+import json
+import collections
+import itertools
+import lzma
+import bz2
 from stat import *
 import shutil
+import tempfile
+import threading
+
+BOOTIMG_HEADER = struct.Struct('<8s10I16s512s32s')
 
 def sha_file(sha, file):
     if file is None:
         return
+    if not hasattr(file, 'read'):
+        sha.update(file)
+        return
     file.seek(0, 0)
     while True:
         data = file.read(65536)
@@ -26,7 +42,7 @@ def write_bootimg(output, kernel, ramdisk, second,
         tags_addr, page_size, padding_size, dt_image):
     ''' make C8600-compatible bootimg.
         output: file object
-        kernel, ramdisk, second: file object or string
+        kernel, ramdisk, second, dt_image: file object or bytes-like
         name, cmdline: string
         base, page_size, padding_size: integer size
 
@@ -34,6 +50,9 @@ def write_bootimg(output, kernel, ramdisk, second,
         http://android.git.kernel.org/?p=platform/system/core.git;a=blob;f=mkbootimg/bootimg.h
 
         Note: padding_size is not equal to page_size in HuaWei C8600
+
+        contents are read once, in 64K chunks, the sha1 id is computed
+        on the way and the header is written last when output is seekable.
     '''
 
     if name is None:
@@ -72,150 +91,594 @@ def write_bootimg(output, kernel, ramdisk, second,
     if not hasattr(output, 'write'):
         output = sys.stdout
 
-    padding = lambda x: struct.pack('%ds' % ((~x + 1) & (padding_size - 1)), '')
+    padding = lambda x: bytes((~x + 1) & (padding_size - 1))
+    latin = lambda x: x.encode('latin')
 
-    def getsize(x):
+    def writecontent(output, x, sha):
+        ''' stream x to output in chunks, feed sha, return the size. '''
         if x is None:
             return 0
-        assert hasattr(x, 'seek')
-        assert hasattr(x, 'tell')
-        x.seek(0, 2)
-        return x.tell()
 
-    def writecontent(output, x):
-        if x is None:
-            return None
-
-        assert hasattr(x, 'read')
+        if not hasattr(x, 'read'):
+            if sha is not None:
+                sha.update(x)
+            output.write(x)
+            output.write(padding(len(x)))
+            return len(x)
 
         x.seek(0, 0)
-        output.write(x.read())
-        output.write(padding(x.tell()))
+        size = 0
+        while True:
+            data = x.read(65536)
+            if not data:
+                break
+            if sha is not None:
+                sha.update(data)
+            output.write(data)
+            size += len(data)
+        output.write(padding(size))
 
         if hasattr(x, 'close'):
             x.close()
+        return size
 
-    sha = hashlib.sha1()
-    sha_file(sha, kernel)
-    sha.update(struct.pack('<I', getsize(kernel)))
-    sha_file(sha, ramdisk)
-    sha.update(struct.pack('<I', getsize(ramdisk)))
-    sha_file(sha, second)
-    sha.update(struct.pack('<I', getsize(second)))
+    def getsize(x):
+        if x is None:
+            return 0
+        if not hasattr(x, 'read'):
+            return len(x)
+        assert hasattr(x, 'seek')
+        assert hasattr(x, 'tell')
+        x.seek(0, 2)
+        return x.tell()
+
+    # dt_image only takes part in the id when there is one
+    contents = [kernel, ramdisk, second]
     if dt_image is not None:
-        sha_file(sha, dt_image)
-        sha.update(struct.pack('<I', getsize(dt_image)))
-    id = sha.digest()
+        contents.append(dt_image)
+
+    # reserve the header page, stream the contents while hashing them,
+    # then go back and fill in the header. unseekable outputs (stdout)
+    # need the id up front, so every input is read once more for them.
+    seekable = hasattr(output, 'seekable') and output.seekable()
+    sha = hashlib.sha1()
+    if not seekable:
+        for x in contents:
+            sha_file(sha, x)
+            sha.update(struct.pack('<I', getsize(x)))
 
     kernel_addr = base + 0x00008000
-    output.write(struct.pack('<8s10I16s512s32s', 'ANDROID!',
-        getsize(kernel), kernel_addr,
-        getsize(ramdisk), ramdisk_addr,
-        getsize(second), second_addr,
-        tags_addr, page_size, getsize(dt_image), 0,
-        name, cmdline, id))
-
-    output.write(padding(608))
-    writecontent(output, kernel)
-    writecontent(output, ramdisk)
-    writecontent(output, second)
-    writecontent(output, dt_image)
+    header = lambda sizes, id: BOOTIMG_HEADER.pack(b'ANDROID!',
+        sizes[0], kernel_addr,
+        sizes[1], ramdisk_addr,
+        sizes[2], second_addr,
+        tags_addr, page_size, sizes[3], 0,
+        latin(name), latin(cmdline), id)
+
+    if seekable:
+        start = output.tell()
+        output.write(bytes(BOOTIMG_HEADER.size))
+    else:
+        sizes = [getsize(x) for x in contents] + [0]
+        output.write(header(sizes, sha.digest()))
+    output.write(padding(BOOTIMG_HEADER.size))
+
+    sizes = []
+    for x in contents:
+        size = writecontent(output, x, seekable and sha or None)
+        sha.update(struct.pack('<I', size))
+        sizes.append(size)
+    sizes.append(0)
+
+    if seekable:
+        end = output.tell()
+        output.seek(start, 0)
+        output.write(header(sizes, sha.digest()))
+        output.seek(end, 0)
     if hasattr('output', 'close'):
         output.close()
 
+def map_file(fileobj):
+    ''' map fileobj read-only for zero-copy access.
+        fall back to reading the whole file if it can not be mapped
+        (pipes, BytesIO, empty files).
+    '''
+    try:
+        return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        fileobj.seek(0, 0)
+        return fileobj.read()
+
+NONZERO = re.compile(b'[^\x00]')
+
+def find_bootimg_padding(buf, start, page_size, sizes):
+    ''' find padding_size of the bootimg at start of buf.
+        sizes: (kernel_size, ramdisk_size, second_size, dt_size)
+
+        the kernel starts at the first non-zero page after the header,
+        padding_size is that offset. power of two multiples of page_size
+        are tried first with a few targeted reads each: the page before
+        the kernel is zero, the kernel page and the ramdisk page are not,
+        and the whole layout fits in buf. if none fits, the first
+        non-zero byte after the header is searched for in one pass.
+    '''
+    length = len(buf) - start
+    iszero = lambda x, y: NONZERO.search(buf, start + x, start + y) is None
+    align = lambda x, y: (x + y - 1) & ~(y - 1)
+
+    size = page_size
+    while size < length:
+        ramdisk = size + align(sizes[0], size)
+        total = size + sum(align(x, size) for x in sizes)
+        if (total <= length
+                and (size == page_size or iszero(size - page_size, size))
+                and not iszero(size, size + page_size)
+                and (not sizes[1] or not iszero(ramdisk, ramdisk + page_size))):
+            return size
+        size <<= 1
+
+    found = NONZERO.search(buf, start + page_size)
+    if found is None:
+        return length
+    return (found.start() - start) // page_size * page_size
+
+BOOTIMG_EXTRA = struct.Struct('<1024s')              # extra_cmdline, v0-v2
+BOOTIMG_V1 = struct.Struct('<IQI')                  # recovery_dtbo_size/offset, header_size
+BOOTIMG_V2 = struct.Struct('<IQ')                   # dtb_size, dtb_addr
+BOOTIMG_V3 = struct.Struct('<8s4I16sI1536s')
+BOOTIMG_V4 = struct.Struct('<I')                    # signature_size
+VENDOR_BOOTIMG_V3 = struct.Struct('<8s5I2048sI16sIIQ')
+VENDOR_BOOTIMG_V4 = struct.Struct('<4I')            # ramdisk table, bootconfig
+BOOTIMG_V3_PAGE_SIZE = 4096
+
+class BootImgHeader(object):
+    ''' versioned bootimg header.
+        ANDROID! header_version 0 (C8600/qcom dt_image layout) to 4,
+        VNDRBOOT vendor_boot header_version 3 and 4.
+
+        buf: mmap or bytes of the image
+        start: offset of the header in buf
+
+        only the header is parsed here. the section table is built on
+        first use from header sizes alone, so section(name) of a large
+        image costs a header read plus the slice of that one section.
+    '''
+
+    def __init__(self, buf, start=0):
+        self.buf = buf
+        self.start = start
+        self._sections = None
+        self.magic = bytes(buf[start:start + 8])
+        self.vendor = self.magic == b'VNDRBOOT'
+        assert self.vendor or self.magic == b'ANDROID!', 'invald bootimg'
+
+        self.header_version = 0
+        self.kernel_size = self.ramdisk_size = self.second_size = 0
+        self.kernel_addr = self.ramdisk_addr = self.second_addr = 0
+        self.tags_addr = self.os_version = self.dt_size = 0
+        self.recovery_dtbo_size = self.recovery_dtbo_offset = 0
+        self.dtb_size = self.dtb_addr = self.signature_size = 0
+        self.ramdisk_table_size = self.ramdisk_table_entry_num = 0
+        self.ramdisk_table_entry_size = self.bootconfig_size = 0
+        self.name = self.cmdline = self.extra_cmdline = self.id = b''
+
+        if self.vendor:
+            (   magic, self.header_version, self.page_size,
+                self.kernel_addr, self.ramdisk_addr, self.ramdisk_size,
+                self.cmdline, self.tags_addr, self.name,
+                self.header_size, self.dtb_size, self.dtb_addr,
+            ) = VENDOR_BOOTIMG_V3.unpack_from(buf, start)
+            if self.header_version > 3:
+                (   self.ramdisk_table_size,
+                    self.ramdisk_table_entry_num,
+                    self.ramdisk_table_entry_size,
+                    self.bootconfig_size,
+                ) = VENDOR_BOOTIMG_V4.unpack_from(buf, start + VENDOR_BOOTIMG_V3.size)
+            return
+
+        # header_version shares its slot with the qcom dt_size of old
+        # images, a real dt_image is never 4 bytes or less.
+        version, = struct.unpack_from('<I', buf, start + 40)
+        if version >= 3 and version <= 4:
+            (   magic, self.kernel_size, self.ramdisk_size, self.os_version,
+                self.header_size, reserved, self.header_version, self.cmdline,
+            ) = BOOTIMG_V3.unpack_from(buf, start)
+            self.page_size = BOOTIMG_V3_PAGE_SIZE
+            if self.header_version > 3:
+                self.signature_size, = BOOTIMG_V4.unpack_from(buf, start + BOOTIMG_V3.size)
+            return
+
+        (   magic,
+            self.kernel_size, self.kernel_addr,
+            self.ramdisk_size, self.ramdisk_addr,
+            self.second_size, self.second_addr,
+            self.tags_addr, self.page_size, version, self.os_version,
+            self.name, self.cmdline, self.id,
+        ) = BOOTIMG_HEADER.unpack_from(buf, start)
+        self.header_size = BOOTIMG_HEADER.size
+        if version > 4:
+            self.dt_size = version
+            return
+
+        self.header_version = version
+        offset = start + BOOTIMG_HEADER.size
+        self.extra_cmdline, = BOOTIMG_EXTRA.unpack_from(buf, offset)
+        offset += BOOTIMG_EXTRA.size
+        if version > 0:
+            (   self.recovery_dtbo_size,
+                self.recovery_dtbo_offset,
+                self.header_size,
+            ) = BOOTIMG_V1.unpack_from(buf, offset)
+            offset += BOOTIMG_V1.size
+        if version > 1:
+            self.dtb_size, self.dtb_addr = BOOTIMG_V2.unpack_from(buf, offset)
+
+    @property
+    def base(self):
+        return self.kernel_addr - 0x00008000
+
+    @property
+    def padding_size(self):
+        ''' alignment of the sections, header_version 0 images may pad
+            more than page_size and have it detected from the contents.
+        '''
+        if self.vendor or self.header_version > 0:
+            return self.page_size
+        if not hasattr(self, '_padding_size'):
+            self._padding_size = find_bootimg_padding(self.buf, self.start,
+                    self.page_size, (self.kernel_size, self.ramdisk_size,
+                                     self.second_size, self.dt_size))
+        return self._padding_size
+
+    @property
+    def sections(self):
+        ''' [(name, offset, size), ...] of every non-empty section. '''
+        if self._sections is not None:
+            return self._sections
+
+        if self.vendor:
+            sizes = [('vendor_ramdisk', self.ramdisk_size),
+                     ('dtb', self.dtb_size),
+                     ('vendor_ramdisk_table', self.ramdisk_table_size),
+                     ('bootconfig', self.bootconfig_size)]
+            first = self.header_size
+        elif self.header_version > 2:
+            sizes = [('kernel', self.kernel_size),
+                     ('ramdisk', self.ramdisk_size),
+                     ('signature', self.signature_size)]
+            first = self.page_size
+        else:
+            sizes = [('kernel', self.kernel_size),
+                     ('ramdisk', self.ramdisk_size),
+                     ('second', self.second_size),
+                     ('dt_image', self.dt_size),
+                     ('recovery_dtbo', self.recovery_dtbo_size),
+                     ('dtb', self.dtb_size)]
+            first = self.header_version > 0 and self.header_size or 1
+
+        size = self.padding_size
+        align = lambda x: (x + size - 1) & ~(size - 1)
+        offset = self.start + align(first)
+        self._sections = []
+        for name, length in sizes:
+            if not length:
+                continue
+            self._sections.append((name, offset, length))
+            offset += align(length)
+        return self._sections
+
+    def section(self, name):
+        ''' return (offset, size) of section name, or None. '''
+        for section in self.sections:
+            if section[0] == name:
+                return section[1:]
+        return None
+
+    def index(self):
+        ''' sections with the file extension of their compression,
+            [(name, offset, size, ext), ...]
+        '''
+        gzname = lambda x: x == struct.pack('3B', 0x1f, 0x8b, 0x08) and '.gz' or ''
+        return [(name, offset, size, gzname(self.buf[offset:offset + 3]))
+                for name, offset, size in self.sections]
+
+class BootImage(object):
+    ''' bootimg held in memory.
+
+        BootImage.load(bootimg) parses bytes or a file object, every
+        section is a memoryview of the source until it is replaced.
+        write(output) serializes to a file object. nothing is read from
+        or written to the working directory, so any number of images
+        can be handled at once in one process.
+
+        img = BootImage.load(open('boot.img', 'rb'))
+        img.replace('ramdisk', data)
+        img.cmdline += ' androidboot.selinux=permissive'
+        img.write(open('boot-new.img', 'wb'))
+    '''
+
+    # what write_bootimg can put back
+    SECTIONS = ('kernel', 'ramdisk', 'second', 'dt_image')
+
+    def __init__(self):
+        self.base = None
+        self.ramdisk_addr = None
+        self.second_addr = None
+        self.tags_addr = None
+        self.name = None
+        self.cmdline = None
+        self.page_size = None
+        self.padding_size = None
+        self.mtk_name = None
+        self.header = None
+        self.sections = {}
+        self._buf = None
+
+    @classmethod
+    def load(cls, bootimg):
+        ''' bootimg: bytes-like or file object, mtk head is skipped. '''
+        self = cls()
+        if hasattr(bootimg, 'read'):
+            buf = map_file(bootimg)
+        else:
+            buf = bootimg
+        self._buf = buf
+
+        start = 0
+        if len(buf) >= 0x200 and struct.unpack_from('<I', buf)[0] == 0x58881688:
+            size, name = struct.unpack_from('<I32s', buf, 4)
+            assert size == len(buf) - 0x200, 'Incomplete or wrong file'
+            self.mtk_name = name.decode('latin').strip('\x00')
+            start = 0x200
+
+        header = self.header = BootImgHeader(buf, start)
+        self.base = header.base
+        self.ramdisk_addr = header.ramdisk_addr
+        self.second_addr = header.second_addr
+        self.tags_addr = header.tags_addr
+        self.name = header.name.decode('latin').strip('\x00')
+        self.cmdline = header.cmdline.decode('latin').strip('\x00')
+        self.page_size = header.page_size
+        self.padding_size = header.padding_size
+
+        view = memoryview(buf)
+        for name, offset, size in header.sections:
+            self.sections[name] = view[offset:offset + size]
+        view.release()
+        return self
+
+    def replace(self, name, data):
+        ''' replace (or add) section name, data: bytes-like, file object
+            or None to drop it. '''
+        old = self.sections.pop(name, None)
+        if isinstance(old, memoryview):
+            old.release()
+        if data is not None:
+            self.sections[name] = data
+
+    def read_bootinfo(self, bootinfo):
+        ''' fill fields still None from a bootinfo.txt file object. '''
+        hexint = lambda x: int(x, 16)
+        fields = {'base': hexint,
+                  'ramdisk_addr': hexint,
+                  'second_addr': hexint,
+                  'tags_addr': hexint,
+                  'page_size': hexint,
+                  'padding_size': hexint,
+                  'name': str.strip,
+                  'cmdline': str.strip,
+                  'mtk_header_name': str.strip}
+        for line in bootinfo.readlines():
+            lines = line.rstrip('\n').split(':', 1)
+            if len(lines) < 2 or lines[0][:1] == '#':
+                continue
+            key = lines[0].strip()
+            if key == 'mode' and lines[1].strip() == 'mtk' and self.mtk_name is None:
+                self.mtk_name = ''
+            elif key == 'mtk_header_name':
+                self.mtk_name = lines[1].strip()
+            elif key in fields and getattr(self, key) is None:
+                setattr(self, key, fields[key](lines[1]))
+
+    def write_bootinfo(self, bootinfo):
+        ''' write the fields repack needs to a bootinfo.txt file object. '''
+        header = self.header
+        vendor = header is not None and header.vendor
+        version = header is not None and header.header_version or 0
+        legacy = not vendor and version < 3
+
+        if self.mtk_name is not None:
+            bootinfo.write('mode:mtk\n')
+            bootinfo.write('mtk_header_name:%s\n' % self.mtk_name)
+        if vendor or version:
+            bootinfo.write('header_version:%d\n' % version)
+        if not vendor and header is not None and header.os_version:
+            bootinfo.write('os_version:0x%x\n' % header.os_version)
+        if vendor or legacy:
+            bootinfo.write('base:0x%x\n' % self.base)
+            bootinfo.write('ramdisk_addr:0x%x\n' % self.ramdisk_addr)
+            if legacy:
+                bootinfo.write('second_addr:0x%x\n' % self.second_addr)
+            bootinfo.write('tags_addr:0x%x\n' % self.tags_addr)
+        if header is not None and header.dtb_addr:
+            bootinfo.write('dtb_addr:0x%x\n' % header.dtb_addr)
+        bootinfo.write('page_size:0x%x\n' % self.page_size)
+        bootinfo.write('name:%s\n' % self.name)
+        bootinfo.write('cmdline:%s\n' % self.cmdline)
+        bootinfo.write('padding_size:0x%x\n' % self.padding_size)
+
+    def write(self, output):
+        ''' serialize to file object output, mtk head included. '''
+        unknown = [x for x in self.sections if x not in self.SECTIONS]
+        assert not unknown, 'can not write sections %s' % ', '.join(unknown)
+
+        if self.mtk_name is not None:
+            start = output.tell()
+            output.write(bytes(0x200))
+        write_bootimg(output,
+                      self.sections.get('kernel'),
+                      self.sections.get('ramdisk'),
+                      self.sections.get('second'),
+                      self.name, self.cmdline, self.base,
+                      self.ramdisk_addr, self.second_addr, self.tags_addr,
+                      self.page_size, self.padding_size,
+                      self.sections.get('dt_image'))
+        if self.mtk_name is not None:
+            end = output.tell()
+            output.seek(start, 0)
+            output.write(pack_mtk_head(end - start - 0x200, self.mtk_name))
+            output.seek(end, 0)
+
+    def close(self):
+        ''' release the sections and the mapping of the source. '''
+        for name in list(self.sections):
+            self.replace(name, None)
+        if hasattr(self._buf, 'close'):
+            self._buf.close()
+        self._buf = None
+
 def parse_bootimg(bootimg):
     ''' parse C8600-compatible bootimg.
         write kernel to kernel[.gz]
         write ramdisk to ramdisk[.gz]
         write second to second[.gz]
 
+        header_version 1 to 4 bootimgs and vendor_boot images are
+        accepted too, their extra sections are written by name
+        (recovery_dtbo, dtb, signature, vendor_ramdisk, ...).
+
+        bootimg is mapped read-only and every section is written straight
+        from a memoryview of the mapping, nothing is copied into memory.
+
         official document:
         http://android.git.kernel.org/?p=platform/system/core.git;a=blob;f=mkbootimg/bootimg.h
 
         Note: padding_size is not equal to page_size in HuaWei C8600
     '''
 
-    bootinfo = open('bootinfo.txt', 'w')
-    check_mtk_head(bootimg, bootinfo)
-
-    (   magic,
-        kernel_size, kernel_addr,
-        ramdisk_size, ramdisk_addr,
-        second_size, second_addr,
-        tags_addr, page_size, dt_size, zero,
-        name, cmdline, id4x8
-    ) = struct.unpack('<8s10I16s512s32s', bootimg.read(608))
-    bootimg.seek(page_size - 608, 1)
-
-    base = kernel_addr - 0x00008000
-    assert magic.decode('latin') == 'ANDROID!', 'invald bootimg'
-    if not base == ramdisk_addr - 0x01000000:
-        sys.stderr.write('found nonstandard ramdisk_addr\n')
-    if not base == second_addr - 0x00f00000:
-        sys.stderr.write('found nonstandard second_addr\n')
-    if not base == tags_addr - 0x00000100:
-        sys.stderr.write('found nonstandard tags_addr\n')
-    if dt_size:
+    img = BootImage.load(bootimg)
+    header = img.header
+    legacy = not header.vendor and header.header_version < 3
+
+    base = img.base
+    if img.mtk_name is not None:
+        sys.stderr.write('Found mtk magic, skip header.\n')
+        sys.stderr.write('Found header name %s\n' % img.mtk_name)
+    if legacy:
+        if not base == img.ramdisk_addr - 0x01000000:
+            sys.stderr.write('found nonstandard ramdisk_addr\n')
+        if not base == img.second_addr - 0x00f00000:
+            sys.stderr.write('found nonstandard second_addr\n')
+        if not base == img.tags_addr - 0x00000100:
+            sys.stderr.write('found nonstandard tags_addr\n')
+    if header.dt_size:
         sys.stderr.write('found device_tree_image\n')
 
-    sys.stderr.write('base: 0x%x\n' % base)
-    sys.stderr.write('ramdisk_addr: 0x%x\n' % ramdisk_addr)
-    sys.stderr.write('second_addr: 0x%x\n' % second_addr)
-    sys.stderr.write('tags_addr: 0x%x\n' % tags_addr)
-    sys.stderr.write('page_size: %d\n' % page_size)
-    sys.stderr.write('name: "%s"\n' % name.decode('latin').strip('\x00'))
-    sys.stderr.write('cmdline: "%s"\n' % cmdline.decode('latin').strip('\x00'))
-
-    bootinfo.write('base:0x%x\n' % base)
-    bootinfo.write('ramdisk_addr:0x%x\n' % ramdisk_addr)
-    bootinfo.write('second_addr:0x%x\n' % second_addr)
-    bootinfo.write('tags_addr:0x%x\n' % tags_addr)
-    bootinfo.write('page_size:0x%x\n' % page_size)
-    bootinfo.write('name:%s\n' % name.decode('latin').strip('\x00'))
-    bootinfo.write('cmdline:%s\n' % cmdline.decode('latin').strip('\x00'))
+    if header.vendor or header.header_version:
+        sys.stderr.write('header_version: %d%s\n' % (header.header_version,
+                         header.vendor and ' (vendor_boot)' or ''))
+    if not header.vendor and header.os_version:
+        sys.stderr.write('os_version: 0x%x\n' % header.os_version)
+    if header.vendor or legacy:
+        sys.stderr.write('base: 0x%x\n' % base)
+        sys.stderr.write('ramdisk_addr: 0x%x\n' % img.ramdisk_addr)
+        if legacy:
+            sys.stderr.write('second_addr: 0x%x\n' % img.second_addr)
+        sys.stderr.write('tags_addr: 0x%x\n' % img.tags_addr)
+    sys.stderr.write('page_size: %d\n' % img.page_size)
+    sys.stderr.write('name: "%s"\n' % img.name)
+    sys.stderr.write('cmdline: "%s"\n' % img.cmdline)
+    sys.stderr.write('padding_size=%d\n' % img.padding_size)
 
-    while True:
-        if bootimg.read(page_size) == struct.pack('%ds' % page_size, ''):
-            continue
-        bootimg.seek(-page_size, 1)
-        size = bootimg.tell()
-        break
+    bootinfo = open('bootinfo.txt', 'w')
+    img.write_bootinfo(bootinfo)
+    bootinfo.close()
 
-    padding = lambda x: (~x + 1) & (size - 1)
-    sys.stderr.write('padding_size=%d\n' % size)
+    for name, offset, size, ext in header.index():
+        output = open('%s%s' % (name, ext), 'wb')
+        output.write(img.sections[name])
+        output.close()
 
-    bootinfo.write('padding_size:0x%x\n' % size)
-    bootinfo.close()
+    img.close()
+    bootimg.close()
 
-    gzname = lambda x: x == struct.pack('3B', 0x1f, 0x8b, 0x08) and '.gz' or ''
+def extract_bootimg_section(bootimg=None, name=None, out=None):
+    if bootimg is None or name is None:
+        sys.stderr.write('arguments: bootimg section [out file]\n')
+        return
+    if out is None:
+        out = name
+    sys.stderr.write('bootimg file: %s\n' % bootimg)
+    sys.stderr.write('section: %s\n' % name)
+    sys.stderr.write('output: %s\n' % out)
 
-    kernel = bootimg.read(kernel_size)
-    output = open('kernel%s' % gzname(kernel[:3]) , 'wb')
-    output.write(kernel)
-    output.close()
-    bootimg.seek(padding(kernel_size), 1)
+    imgfile = open(bootimg, 'rb')
+    check_mtk_head(imgfile, io.StringIO())
+    start = imgfile.tell()
+    buf = map_file(imgfile)
+    header = BootImgHeader(buf, start)
+    section = header.section(name)
+    if section is None:
+        imgfile.close()
+        raise SystemExit('no %s in %s, found: %s' % (name, bootimg,
+                         ' '.join(x[0] for x in header.sections)))
 
-    ramdisk = bootimg.read(ramdisk_size)
-    output = open('ramdisk%s' % gzname(ramdisk[:3]) , 'wb')
-    output.write(ramdisk)
-    output.close()
-    bootimg.seek(padding(ramdisk_size), 1)
+    offset, size = section
+    with memoryview(buf) as view:
+        outfile = open(out, 'wb')
+        outfile.write(view[offset:offset + size])
+        outfile.close()
 
-    if second_size:
-        second = bootimg.read(second_size)
-        output = open('second%s' % gzname(second[:3]) , 'wb')
-        output.write(second)
-        output.close()
-        bootimg.seek(padding(ramdisk_size), 1)
+    if hasattr(buf, 'close'):
+        buf.close()
+    imgfile.close()
 
-    if dt_size:
-        dt_image = bootimg.read(dt_size)
-        output = open('dt_image%s' % gzname(dt_image[:3]) , 'wb')
-        output.write(dt_image)
-        output.close()
-#        bootimg.seek(padding(second_size), 1)
+def analyze_kernel_file(kernel=None, out=None):
+    if kernel is None:
+        kernel = 'kernel.gz' if os.path.exists('kernel.gz') else 'kernel'
+    sys.stderr.write('arguments: [kernel file or bootimg] [out Image]\n')
+    sys.stderr.write('kernel file: %s\n' % kernel)
+    sys.stderr.write('output: %s\n' % out)
 
-    bootimg.close()
+    kernelfile = open(kernel, 'rb')
+    check_mtk_head(kernelfile, io.StringIO())
+    start = kernelfile.tell()
+    buf = map_file(kernelfile)
+    outfile = out and open(out, 'wb')
+    report = None
+    try:
+        with memoryview(buf) as view:
+            if bytes(view[start:start + 8]) == b'ANDROID!':
+                section = BootImgHeader(buf, start).section('kernel')
+            else:
+                section = start, len(view) - start
+            if section is not None:
+                offset, size = section
+                with view[offset:offset + size] as payload:
+                    report = analyze_kernel(payload, outfile)
+    finally:
+        if outfile:
+            outfile.close()
+            # never leave an empty or partial kernel behind
+            if report is None or report['size'] is None:
+                os.remove(out)
+        if hasattr(buf, 'close'):
+            buf.close()
+        kernelfile.close()
+    if report is None:
+        raise SystemExit('%s: boot image has no kernel' % kernel)
+    if out and report['size'] is None:
+        raise SystemExit('%s: no kernel found, nothing written to %s' % (kernel, out))
+
+    sys.stdout.write('compression: %s\n' % report['compression'])
+    if report['offset'] is not None:
+        sys.stdout.write('payload offset: 0x%x\n' % report['offset'])
+    if report['compressed_size'] is not None:
+        sys.stdout.write('payload size: %d\n' % report['compressed_size'])
+    if report['size'] is not None:
+        sys.stdout.write('decompressed size: %d\n' % report['size'])
+    sys.stdout.write('version: %s\n' % report['version'])
+    return report
 
 # CRC CCITT
 crc_ccitt_table = []
@@ -227,10 +690,39 @@ for crc in range(0, 256):
             crc >>= 1
     crc_ccitt_table.append(crc)
 
+# every byte bit reversed: the lsb first crc above is binascii.crc_hqx,
+# the msb first crc-ccitt in C, of the reversed data, reversed back
+CRC_REVERSE = bytes(int('{:08b}'.format(x)[::-1], 2) for x in range(256))
+reverse16 = lambda x: CRC_REVERSE[x & 0xff] << 8 | CRC_REVERSE[x >> 8]
+
 def crc_ccitt(data, crc=0xffff):
-    for item in data:
-        crc = (crc >> 8) ^ crc_ccitt_table[crc & 0xff ^ item]
-    return crc
+    ''' crc-ccitt as crc_ccitt_table defines it, without the final xor.
+        data: bytes-like or a list of byte values
+    '''
+    return reverse16(binascii.crc_hqx(bytes(data).translate(CRC_REVERSE), reverse16(crc)))
+
+def crc_ccitt_blocks(data, block_size=4096):
+    ''' crc_ccitt of every block_size bytes of data (bytes-like), bit
+        reversed 1M at a time. return [crc, ...]
+    '''
+    crcs = []
+    step = max(block_size, (1 << 20) // block_size * block_size)
+    with memoryview(data) as view:
+        for start in range(0, len(view), step):
+            chunk = view[start:start + step].tobytes().translate(CRC_REVERSE)
+            for offset in range(0, len(chunk), block_size):
+                crc = binascii.crc_hqx(chunk[offset:offset + block_size], 0xffff)
+                crcs.append(reverse16(crc))
+    return crcs
+
+def verify_crc_ccitt(header, data, block_size=4096):
+    ''' check data against header, the little endian crc_ccitt ^ 0xffff of
+        each block as UPDATA.APP stores them, in one pass.
+        return [index of bad block, ...]
+    '''
+    crcs = crc_ccitt_blocks(data, block_size)
+    stored = struct.unpack_from('<%dH' % len(crcs), header)
+    return [i for i, crc in enumerate(crcs) if crc ^ 0xffff != stored[i]]
 
 #def write_crc(data, output):
 #    crc = crc_ccitt(data) ^ 0xffff
@@ -267,7 +759,7 @@ def parse_updata(updata, debug=False):
         data = updata.read(4)
         if not data:
             break
-        if data == struct.pack('4s', ''):
+        if data == struct.pack('4s', b''):
             continue
 
         data += updata.read(94)
@@ -295,7 +787,7 @@ def parse_updata(updata, debug=False):
         assert tag2 == 0x00100000, 'invalid tag2 %x' % tag2
 
         remain = header_length - 98
-        header = list(struct.unpack('%dB' % remain, updata.read(remain)))
+        header = updata.read(remain)
 
         sys.stderr.write('0x%x %x %d\n' % (position, unknown, content_length))
 
@@ -305,14 +797,13 @@ def parse_updata(updata, debug=False):
             output = open(POSITION.get(position, os.devnull), 'wb')
 
         remain = content_length
+        block = 0
         while remain > 0:
-            size = remain > 4096 and 4096 or remain
+            size = min(remain, 1 << 20)
             data = updata.read(size)
             if debug:
-                check = list(struct.unpack('%dB' % size, data))
-                check.append(header.pop(0))
-                check.append(header.pop(0))
-                assert crc_ccitt(check) == 0xf0b8
+                assert not verify_crc_ccitt(header[block * 2:], data), 'bad crc'
+                block += (size + 4095) // 4096
             output.write(data)
             remain -= size
         output.close()
@@ -332,9 +823,13 @@ ZTE_PARTITIONS = {0x1 : 'qcsblhd_cfgdata.mbn',
                   0x14: 'system.img',
                   0x1c: 'partition.mbn',
                   0x1d: 'partition_zte.mbn',}
-def parse_zte_bin(binfile, debug=False):
+# a partition of ZTE image.bin or a qsb file, size bytes at offset
+ZtePartition = collections.namedtuple('ZtePartition', 'partitionid name file offset size')
+
+def parse_zte_bin(binfile, debug=False, directory='.', only=None, threads=None):
     ''' parse ZTE image.bin.
-        if debug is true or 1 or yes, write content to [position], else according POSITION
+        if debug is true or 1 or yes, write debug info to stderr
+        only: partition file names to extract, default all
 
         image.bin Structure (only guess)
         magic1                    |  char[0x40]  'ZTE SOFTWARE UPDATE PACKAGE'
@@ -354,58 +849,52 @@ def parse_zte_bin(binfile, debug=False):
         head_size                 |  unsigned int
     '''
 
-    magic1 = binfile.read(64)
-    assert magic1, 'invalid binfile'
-    assert len(magic1) == 64, 'invalid binfile'
-    assert magic1 == struct.pack('64s', 'ZTE SOFTWARE UPDATE PACKAGE'), 'invalid binfile'
-
-    data = binfile.read(4)
-    partition_num = struct.unpack('<I', data)
+    entries = list_zte_bin(binfile)
     if debug:
-        sys.stderr.write('found %d partitions\n' % partition_num)
-
-    remain = partition_num[0]
-    last = binfile.tell()
-    while remain > 0:
-        binfile.seek(last)
-        data = binfile.read(24)
+        for entry in entries:
+            sys.stderr.write('partition 0x%x: %s, off 0x%x, size %d Bytes\n' % (entry.partitionid,
+                             entry.file, entry.offset, entry.size))
+    return extract_partitions(binfile, entries, directory, only, threads)
+
+def list_zte_bin(binfile):
+    ''' index ZTE image.bin (file object) from its partition table, see
+        parse_zte_bin. a head is an entry of its own, after its partition.
+        return [ZtePartition, ...]
+    '''
+    magic = struct.pack('64s', b'ZTE SOFTWARE UPDATE PACKAGE')
+    binfile.seek(0)
+    data = binfile.read(68)
+    assert len(data) == 68, 'invalid binfile'
+    assert data[:64] == magic, 'invalid binfile'
+
+    partition_num = struct.unpack('<I', data[64:])[0]
+    data = binfile.read(24 * partition_num)
+    assert len(data) == 24 * partition_num, 'invalid binfile'
+    entries = []
+    end = 0
+    for i in range(partition_num):
         (   partitionid,
             partition_off,
             partition_size,
             has_head,
             head_off,
             head_size,
-        ) = struct.unpack('<IIIIII', data)
-        last = binfile.tell()
+        ) = struct.unpack_from('<IIIIII', data, i * 24)
         filenames = ZTE_PARTITIONS.get(partitionid, "UNKNOWN_PARTITIONS_%d.img,UNKNOWN_PARTITIONS_%d_HD.img" % (partitionid, partitionid)).split(',')
-        if debug:
-            sys.stderr.write('partition 0x%x: %s, off 0x%x, size %d Bytes\n' % (partitionid, filenames[0], partition_off, partition_size))
-            if has_head == 1:
-                sys.stderr.write('\thas head %s, off 0x%x, size %d Bytes\n' % (filenames[1], head_off, head_size))
+        entries.append(ZtePartition(partitionid, filenames[0], filenames[0], partition_off, partition_size))
+        end = max(end, partition_off + partition_size)
         if has_head == 1:
-            sys.stderr.write('output: %s\n' % filenames[1])
-            output = open(filenames[1], 'wb')
-            binfile.seek(head_off)
-            data = binfile.read(head_size)
-            output.write(data)
-            output.close()
-        sys.stderr.write('output: %s\n' % filenames[0])
-        output = open(filenames[0], 'wb')
-        binfile.seek(partition_off)
-        data = binfile.read(partition_size)
-        output.write(data)
-        output.close()
-        remain -= 1
+            entries.append(ZtePartition(partitionid, filenames[1], filenames[1], head_off, head_size))
+            end = max(end, head_off + head_size)
 
-    binfile.read(64)
-    magic2 = binfile.read(64)
-    assert magic2 == struct.pack('64s', 'ZTE SOFTWARE UPDATE PACKAGE'), 'invalid binfile'
-
-    binfile.close()
+    binfile.seek(end + 64)
+    assert binfile.read(64) == magic, 'invalid binfile'
+    return entries
 
-def parse_qsb(binfile, debug=False):
+def parse_qsb(binfile, debug=False, directory='.', only=None, threads=None):
     ''' parse qsb file.
         if debug is true or 1 or yes, write debug info to stdout
+        only: partition or file names to extract, default all
 
         image.qsb Structure (only guess)
         ??:0xC
@@ -442,18 +931,29 @@ def parse_qsb(binfile, debug=False):
         head_size                 |  unsigned int
     '''
 
+    entries = list_qsb(binfile)
+    if debug:
+        for entry in entries:
+            sys.stderr.write('partition 0x%x: %s[%s], off 0x%x, size %d Bytes\n' % (entry.partitionid,
+                             entry.name, entry.file, entry.offset, entry.size))
+    return extract_partitions(binfile, entries, directory, only, threads)
+
+def list_qsb(binfile):
+    ''' index a qsb file (file object) from its 0x100 byte partition
+        entries, see parse_qsb. partitionid is the entry number.
+        return [ZtePartition, ...]
+    '''
+    text = lambda x: x.split(b'\x00', 1)[0].decode('latin')
     binfile.seek(0x54)
     data = binfile.read(4)
-    partition_num = struct.unpack('<I', data)
-    if debug:
-        sys.stderr.write('found %d partitions\n' % partition_num)
+    assert len(data) == 4, 'invalid qsb'
+    partition_num = struct.unpack('<I', data)[0]
 
-    remain = partition_num[0]
-    cur = 1
-    last = binfile.tell()
-    while cur <= remain:
+    entries = []
+    for cur in range(1, partition_num + 1):
         binfile.seek(cur * 0x100)
         data = binfile.read(0x80)
+        assert len(data) == 0x80, 'invalid qsb'
         (   file_name,
             part_name,
             null,
@@ -462,20 +962,36 @@ def parse_qsb(binfile, debug=False):
             file_size,
             null,
         ) = struct.unpack('<64s32sIIII16s', data)
-        file_name = file_name.strip("\0")
-        part_name = part_name.strip("\0")
-
-        if debug:
-            sys.stderr.write('partition 0x%x: %s[%s], off 0x%x, size %d Bytes\n' % (cur, part_name, file_name, file_off, file_size))
-        sys.stderr.write('output: %s\n' % file_name)
-        output = open(file_name, 'wb')
-        binfile.seek(file_off)
-        data = binfile.read(file_size)
-        output.write(data)
-        output.close()
-        cur += 1
-
-    binfile.close()
+        entries.append(ZtePartition(cur, text(part_name), text(file_name), file_off, file_size))
+    return entries
+
+def extract_partitions(binfile, entries, directory='.', only=None, threads=None):
+    ''' copy the partitions of entries (list_zte_bin, list_qsb) out of
+        binfile (file object) to their file names under directory, a few
+        at once, each one a copy_range, so memory does not grow with
+        the partition size. binfile is closed.
+        only: partition or file names to extract, default all
+        return [(ZtePartition, path), ...]
+    '''
+    tasks = [(x, os.path.join(directory, x.file)) for x in entries
+             if only is None or x.name in only or x.file in only]
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    source = binfile.fileno()
+    def extract(task):
+        entry, path = task
+        copy_range(source, entry.offset, entry.size, path)
+        sys.stderr.write('output: %s\n' % path)
+
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(int(str(threads or 0)) or min(4, len(tasks)) or 1)
+    try:
+        list(pool.map(extract, tasks))
+    finally:
+        pool.shutdown()
+        binfile.close()
+    return tasks
 
 def parse_ext4_img(imgfile, output):
     ''' parse ext4_img by lenovo
@@ -656,98 +1172,133 @@ def repack_img_ext4(imgfile, output):
     imgfile.close()
     output.close()
 
-def write_zte_bin(binfile, debug=False):
-    ''' parse ZTE image.bin.
-        if debug is true or 1 or yes, write content to [position], else according POSITION
-
-        image.bin Structure (only guess)
-        magic1                    |  char[0x40]  'ZTE SOFTWARE UPDATE PACKAGE'
-        partition_num             |  unsigned int
-        partitions[partition_num] |  struct partitions
-        padding...                |  padding to 0x400 bytes
-        content                   |  parse according to partitions[]
-        null                      |  char[0x40]
-        magic2                    |  char[0x40]  'ZTE SOFTWARE UPDATE PACKAGE'
-
-        struct partitions (only guess)
-        partitionid               |  unsigned int
-        partition_off             |  char *
-        partition_size            |  unsigned int
-        has_head                  |  unsigned int
-        head_off                  |  char *
-        head_size                 |  unsigned int
+# the partitions of image.bin as write_zte_bin packs them by default,
+# 'file,partitionid[,head file]'
+ZTE_BIN_FILES = ['partition.mbn,0x1c',
+                 'partition_zte.mbn,0x1d',
+                 'qcsblhd_cfgdata.mbn,0x1',
+                 'qcsbl.mbn,0x2',
+                 'oemsbl.mbn,0x3,oemsblhd.mbn',
+                 'amss.mbn,0x4,amsshd.mbn',
+                 'appsboot.mbn,0x5,appsboothd.mbn',
+                 'boot.img,0x13',
+                 'recovery.img,0x15',
+                 'splash.img,0x19',
+                 'system.img,0x14',]
+
+def load_zte_bin_list(manifest):
+    ''' read the partitions to pack from manifest (file name), one
+        'file,partitionid[,head file]' line each as in ZTE_BIN_FILES,
+        empty lines and # comments skipped.
+    '''
+    files = []
+    for line in open(manifest, 'r'):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            assert len(line.split(',')) in (2, 3), 'invalid manifest line %s' % line
+            files.append(line)
+    return files
+
+def write_zte_bin(binfile, debug=False, files=None, base='.'):
+    ''' write ZTE image.bin, layout as parse_zte_bin reads it.
+        files: ['file,partitionid[,head file]', ...], default ZTE_BIN_FILES,
+               file names relative to base
+        every input is stat'ed and the whole partition table laid out
+        before anything is written, then the contents are copied in
+        order, 1M at a time.
     '''
 
-    magic1 = struct.pack('64s', 'ZTE SOFTWARE UPDATE PACKAGE')
-    binfile.write(magic1)
-
-    files = ['partition.mbn,0x1c',
-             'partition_zte.mbn,0x1d',
-             'qcsblhd_cfgdata.mbn,0x1',
-             'qcsbl.mbn,0x2',
-             'oemsbl.mbn,0x3,oemsblhd.mbn',
-             'amss.mbn,0x4,amsshd.mbn',
-             'appsboot.mbn,0x5,appsboothd.mbn',
-             'boot.img,0x13',
-             'recovery.img,0x15',
-             'splash.img,0x19',
-             'system.img,0x14',]
-    partition_num = struct.pack('<I', len(files))
-    binfile.write(partition_num)
-
-    head = binfile.tell()
-    info = 0x400
-
-    remain = len(files)
+    if files is None:
+        files = ZTE_BIN_FILES
+    assert 0x44 + 24 * len(files) <= 0x400, 'too many partitions'
 
-    i = 0
-    while i < remain:
-        binfile.seek(info)
-        file = files[i].split(',')
+    plan = []
+    offset = 0x400
+    for line in files:
+        file = line.split(',')
+        partitionid = int(file[1], 16)
+        path = os.path.join(base, file[0])
+        head = None
         has_head = 0
         head_off = 0
         head_size = 0
         if len(file) > 2:
+            head = os.path.join(base, file[2])
             has_head = 1
-            head_off = binfile.tell()
-            file_head = file[2]
-            f_head = open(file_head, 'rb')
-            data = f_head.read()
-            head_size = f_head.tell()
-            f_head.close()
-            binfile.write(data)
-        partition_off = binfile.tell()
-        partitionid = int(file[1], 16)
-        file = file[0]
-        f = open(file, 'rb')
-        data = f.read()
-        partition_size = f.tell()
-        f.close()
-        binfile.write(data)
-
-        info = binfile.tell()
-        binfile.seek(head)
-        data = struct.pack('<IIIIII', partitionid,
-                                      partition_off,
-                                      partition_size,
-                                      has_head,
-                                      head_off,
-                                      head_size)
-        binfile.write(data)
-        head = binfile.tell()
-        i += 1
-
-    binfile.seek(info)
-    data = struct.pack('64s', '')
-    binfile.write(data)
-    magic2 = struct.pack('64s', 'ZTE SOFTWARE UPDATE PACKAGE')
+            head_off = offset
+            head_size = os.path.getsize(head)
+            offset += head_size
+        partition_off = offset
+        partition_size = os.path.getsize(path)
+        offset += partition_size
+        plan.append((partitionid, path, head, (partitionid, partition_off, partition_size,
+                                               has_head, head_off, head_size)))
+
+    table = struct.pack('64s', b'ZTE SOFTWARE UPDATE PACKAGE')
+    table += struct.pack('<I', len(plan))
+    table += b''.join(struct.pack('<IIIIII', *x[3]) for x in plan)
+    binfile.write(table + bytes(0x400 - len(table)))
+
+    for partitionid, path, head, entry in plan:
+        for name in (head, path):
+            if name is None:
+                continue
+            if debug:
+                sys.stderr.write('partition 0x%x: %s, off 0x%x\n' % (partitionid, name, binfile.tell()))
+            source = open(name, 'rb')
+            shutil.copyfileobj(source, binfile, 1 << 20)
+            source.close()
+        assert binfile.tell() == entry[1] + entry[2], '%s changed size while packing' % path
+
+    binfile.write(struct.pack('64s', b''))
+    magic2 = struct.pack('64s', b'ZTE SOFTWARE UPDATE PACKAGE')
     binfile.write(magic2)
 
     binfile.close()
 
-def cpio_list(directory, output=None):
+def scan_cpio_list(directory, root, sort=False):
+    ''' list the entries of one directory root under directory the way
+        os.walk orders them, subdirectories first.
+        return [line, ...], [subdirectory to descend, ...]
+    '''
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return [], []
+    dirs = [x for x in entries if x.is_dir()]
+    files = [x for x in entries if not x.is_dir()]
+    if sort:
+        dirs.sort(key=lambda x: x.name)
+        files.sort(key=lambda x: x.name)
+
+    lines = []
+    for entry in dirs + files:
+        path = entry.path
+        info = entry.stat(follow_symlinks=False)
+        name = path.replace(directory, '', 1)
+        name = name.replace(os.sep, '/')    # for windows
+        if name[:1] == '/':
+            name = name[1:]
+        mode = oct(S_IMODE(info.st_mode))
+        if S_ISLNK(info.st_mode):
+            # slink name path mode uid gid
+            realpath = os.readlink(path)
+            lines.append('slink %s %s %s 0 0\n' % (name, realpath, mode))
+        elif S_ISDIR(info.st_mode):
+            # dir name path mode uid gid
+            lines.append('dir %s %s 0 0\n' % (name, mode))
+        elif S_ISREG(info.st_mode):
+            # file name path mode uid gid
+            lines.append('file %s %s %s 0 0\n' % (name, path, mode))
+    return lines, [x.path for x in dirs if not x.is_symlink()]
+
+def cpio_list(directory, output=None, threads=None, sort=False):
     ''' generate gen_cpio_init-compatible list for directory,
         if output is None, write to stdout
+        threads: scan directories on this many threads (0 for one per
+                 cpu), the listing is the same as with one
+        sort: order entries by name instead of as the filesystem returns
+              them, which os.walk and so the default keep
 
         official document:
         http://git.kernel.org/?p=linux/kernel/git/torvalds/linux-2.6.git;a=blob;f=usr/gen_init_cpio.c
@@ -755,136 +1306,456 @@ def cpio_list(directory, output=None):
 
     if not hasattr(output, 'write'):
         output = sys.stdout
-    for root, dirs, files in os.walk(directory):
-        for file in dirs + files:
-            path = os.path.join(root, file)
-            info = os.lstat(path)
-            name = path.replace(directory, '', 1)
-            name = name.replace(os.sep, '/')    # for windows
-            if name[:1] == '/':
-                name = name[1:]
-            mode = oct(S_IMODE(info.st_mode))
-            if S_ISLNK(info.st_mode):
-                # slink name path mode uid gid
-                realpath = os.readlink(path)
-                output.write('slink %s %s %s 0 0\n' % (name, realpath, mode))
-            elif S_ISDIR(info.st_mode):
-                # dir name path mode uid gid
-                output.write('dir %s %s 0 0\n' % (name, mode))
-            elif S_ISREG(info.st_mode):
-                # file name path mode uid gid
-                output.write('file %s %s %s 0 0\n' % (name, path, mode))
+
+    scanned = {}
+    if threads is None:
+        scan = lambda root: scan_cpio_list(directory, root, sort)
+    else:
+        # every directory is one task, subdirectories are queued as
+        # their parent is done, the listing is assembled afterwards
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        pool = ThreadPoolExecutor(int(str(threads)) or os.cpu_count() or 1)
+        pending = {pool.submit(scan_cpio_list, directory, directory, sort): directory}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                root = pending.pop(future)
+                scanned[root] = future.result()
+                for subdir in scanned[root][1]:
+                    pending[pool.submit(scan_cpio_list, directory, subdir, sort)] = subdir
+        pool.shutdown()
+        scan = scanned.pop
+
+    # top-down, as os.walk, lines go out in batches
+    batch = []
+    stack = [directory]
+    while stack:
+        lines, subdirs = scan(stack.pop())
+        batch.extend(lines)
+        if len(batch) >= 4096:
+            output.write(''.join(batch))
+            batch = []
+        stack.extend(reversed(subdirs))
+    output.write(''.join(batch))
 
     if hasattr(output, 'close'):
         output.close()
 
-def parse_cpio(cpio, directory, cpiolist):
+# newc header: magic, then ino, mode, uid, gid, nlink, mtime, filesize,
+# major, minor, rmajor, rminor, namesize, check as 8 hex digits each
+CPIO_HEADER = struct.Struct('6s' + '8s' * 13)
+CPIO_NEWC = '070701' + '%08x' * 13
+CPIO_TRAILER = 'TRAILER!!!'
+
+class BlockReader(object):
+    ''' serve the many small reads of a cpio walk out of large blocks, so a
+        compressed stream is decoded block_size bytes at a time.
+    '''
+
+    def __init__(self, fileobj, block_size=1 << 18):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.buffer = b''
+        self.offset = 0
+
+    def read(self, size):
+        end = self.offset + size
+        if end <= len(self.buffer):
+            data = self.buffer[self.offset:end]
+            self.offset = end
+            return data
+
+        pieces = [self.buffer[self.offset:]]
+        need = size - len(pieces[0])
+        while need > 0:
+            block = self.fileobj.read(max(need, self.block_size))
+            if not block:
+                break
+            pieces.append(block)
+            need -= len(block)
+        self.buffer = b''.join(pieces)
+        self.offset = min(size, len(self.buffer))
+        return self.buffer[:self.offset]
+
+    def close(self):
+        self.fileobj.close()
+
+def iter_cpio(cpio):
+    ''' yield (name, mode, data) for each entry of a newc cpio up to the
+        trailer, one read per header and one per body.
+        a hardlinked file whose body went with an earlier link gets the
+        data of that link.
+        cpio: file object, wrapped in a BlockReader
+    '''
+    reader = BlockReader(cpio)
+    links = {}
+    while True:
+        header = reader.read(CPIO_HEADER.size)
+        assert len(header) == CPIO_HEADER.size, 'truncated cpio'
+        fields = CPIO_HEADER.unpack(header)
+        assert fields[0] == b'070701', 'invalid cpio'
+        mode, filesize, namesize = int(fields[2], 16), int(fields[7], 16), int(fields[12], 16)
+        nlink = int(fields[5], 16)
+
+        # name and its NUL are padded to 4 with the header
+        name = reader.read((namesize + 110 + 3 & ~3) - 110)[:namesize - 1].decode('latin')
+        if name == CPIO_TRAILER:
+            return
+        data = reader.read(filesize + 3 & ~3)[:filesize]
+        if nlink > 1 and S_ISREG(mode):
+            key = fields[1], fields[8], fields[9]
+            if filesize:
+                links[key] = data
+            else:
+                data = links.get(key, data)
+        yield name, mode, data
+
+def write_cpio_file(path, data, mode):
+    ''' create path with data and the permission bits of mode, kept
+        readable and writable by the owner. return the sha1 of data.
+    '''
+    tmp = open(path, 'wb')
+    tmp.write(data)
+    tmp.close()
+    os.chmod(path, S_IMODE(mode) | S_IRUSR | S_IWUSR)
+    return hashlib.sha1(data).hexdigest()
+
+def parse_cpio(cpio, directory, cpiolist, listdir=None, threads=None):
     ''' parse cpio, write content under directory.
         cpio: file object
         directory: string
         cpiolist: file object
+        listdir: directory as written to cpiolist, default directory
+        threads: write regular files on this many threads while the cpio
+                 is decoded, at most 4 files per thread are in flight
+        return [(path, sha1), ...] of the regular files, path as listed
 
         official document: (cpio newc structure)
         http://git.kernel.org/?p=linux/kernel/git/torvalds/linux-2.6.git;a=blob;f=usr/gen_init_cpio.c
     '''
 
-    padding = lambda x: (~x + 1) & 3
-
-    def read_cpio_header(cpio):
-        assert cpio.read(6).decode('latin') == '070701', 'invalid cpio'
-        cpio.read(8) # ignore inode number
-        mode = int(cpio.read(8), 16)
-        cpio.read(8) # uid
-        cpio.read(8) # gid
-        cpio.read(8) # nlink
-        cpio.read(8) # timestamp
-        filesize = int(cpio.read(8), 16)
-        cpio.read(8) # major
-        cpio.read(8) # minor
-        cpio.read(8) # rmajor
-        cpio.read(8) # rminor
-        namesize = int(cpio.read(8), 16)
-        cpio.read(8)
-        name = cpio.read(namesize - 1).decode('latin') # maybe utf8?
-        cpio.read(1)
-        cpio.read(padding(namesize + 110))
-        return name, mode, filesize
-
+    if listdir is None:
+        listdir = directory
     os.makedirs(directory)
+    files = []
 
-    while True:
-        name, mode, filesize = read_cpio_header(cpio)
-        if name == 'TRAILER!!!':
-            break
+    pool = None
+    pending = collections.deque()
+    def collect():
+        listed, future = pending.popleft()
+        files.append((listed, future.result()))
 
-        if name[:1] == '/':
-            name = name[1:]
+    if threads is not None:
+        from concurrent.futures import ThreadPoolExecutor
+        threads = int(str(threads)) or os.cpu_count() or 1
+        pool = ThreadPoolExecutor(threads)
 
-        name = os.path.normpath(name)
-        path = '%s/%s' %(directory, name)
-        name = name.replace(os.sep, '/') # for windows
+    try:
+        for name, mode, data in iter_cpio(cpio):
+            if name[:1] == '/':
+                name = name[1:]
 
-        srwx = oct(S_IMODE(mode))
-        if S_ISLNK(mode):
-            location = cpio.read(filesize)
-            cpio.read(padding(filesize))
-            cpiolist.write('slink %s %s %s\n' % (name, location, srwx))
-        elif S_ISDIR(mode):
-            try: os.makedirs(path)
-            except os.error: pass
-            cpiolist.write('dir %s %s\n' % (name, srwx))
-        elif S_ISREG(mode):
-            tmp = open(path, 'wb')
-            tmp.write(cpio.read(filesize))
-            cpio.read(padding(filesize))
-            tmp.close()
-            cpiolist.write('file %s %s %s\n' % (name, path, srwx))
-        else:
-            cpio.read(filesize)
-            cpio.read(padding(filesize))
+            name = os.path.normpath(name)
+            path = '%s/%s' %(directory, name)
+            name = name.replace(os.sep, '/') # for windows
+
+            srwx = oct(S_IMODE(mode))
+            if S_ISLNK(mode):
+                cpiolist.write('slink %s %s %s\n' % (name, data.decode('latin'), srwx))
+            elif S_ISDIR(mode):
+                try: os.makedirs(path)
+                except os.error: pass
+                cpiolist.write('dir %s %s\n' % (name, srwx))
+            elif S_ISREG(mode):
+                cpiolist.write('file %s %s/%s %s\n' % (name, listdir, name, srwx))
+                listed = '%s/%s' % (listdir, name)
+                if pool is None:
+                    files.append((listed, write_cpio_file(path, data, mode)))
+                    continue
+                # wait for the oldest file so decoded data does not pile up
+                if len(pending) >= threads * 4:
+                    collect()
+                pending.append((listed, pool.submit(write_cpio_file, path, data, mode)))
+
+        while pending:
+            collect()
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
     cpio.close()
     cpiolist.close()
+    return files
+
+def digest_file(path):
+    sha = hashlib.sha1()
+    f = open(path, 'rb')
+    sha_file(sha, f)
+    f.close()
+    return sha.hexdigest()
+
+def write_ramdisk_manifest(manifest, ramdisk, cpiolist, files, base=''):
+    ''' record what repack needs to tell that an unpacked initrd is
+        untouched: the original ramdisk, cpiolist and every file with
+        its size, mtime and sha1.
+        manifest, ramdisk, cpiolist: file names relative to base
+        files: [(path, sha1), ...] as parse_cpio returns them
+        base: directory repack will run in
+    '''
+    entries = []
+    for path, sha1 in files:
+        info = os.stat(os.path.join(base, path))
+        entries.append([path, info.st_size, info.st_mtime_ns, sha1])
+    data = {'ramdisk': ramdisk,
+            'ramdisk_sha1': digest_file(os.path.join(base, ramdisk)),
+            'cpiolist_sha1': digest_file(os.path.join(base, cpiolist)),
+            'files': entries}
+    output = open(os.path.join(base, manifest), 'w')
+    json.dump(data, output)
+    output.close()
+
+def unchanged_ramdisk(cpiolist):
+    ''' return the original ramdisk bytes if neither cpiolist nor any file
+        it lists changed since unpack, else None. files whose mtime moved
+        are compared by sha1, so a touch alone does not force a rebuild.
+    '''
+    manifest = '%s.manifest' % os.path.splitext(cpiolist)[0]
+    try:
+        data = json.load(open(manifest, 'r'))
+        if digest_file(cpiolist) != data['cpiolist_sha1']:
+            return None
+        for path, size, mtime, sha1 in data['files']:
+            info = os.stat(path)
+            if info.st_size != size:
+                return None
+            if info.st_mtime_ns != mtime and digest_file(path) != sha1:
+                return None
+        if digest_file(data['ramdisk']) != data['ramdisk_sha1']:
+            return None
+        return open(data['ramdisk'], 'rb').read()
+    except (IOError, OSError, ValueError, KeyError):
+        return None
 
 #根据system/core/cpio/mkbootfs.c对代码进行修正
-def write_cpio(cpiolist, output):
+class CpioEntry(object):
+    ''' one cpiolist line: type name [args ...] '''
+
+    __slots__ = ('type', 'name', 'args')
+
+    def __init__(self, type, name, *args):
+        self.type = type
+        self.name = name.replace(os.sep, '/') # if any
+        self.args = args
+
+    def __str__(self):
+        return ' '.join((self.type, self.name) + self.args)
+
+class CpioList(object):
+    ''' cpiolist.txt in memory: the option lines (compress_level:6 ...)
+        and the entries in order, indexed by name.
+
+        entries = CpioList.load('cpiolist.txt')
+        entries.replace('file', 'init.rc', 'my/init.rc', '0o750')
+        entries.remove('sbin/adbd')
+        entries.dump(open('cpiolist.txt', 'w'))
+    '''
+
+    TYPES = ('dir', 'file', 'slink', 'nod', 'pipe', 'sock')
+
+    def __init__(self):
+        self.options = collections.OrderedDict()
+        self.entries = collections.OrderedDict()
+
+    @classmethod
+    def parse(cls, cpiolist):
+        ''' cpiolist: file object, the first of duplicate entries is kept. '''
+        self = cls()
+        for line in cpiolist:
+            lines = line.split()
+            if len(lines) < 1 or lines[0][0] == '#':
+                continue
+            if lines[0] in cls.TYPES:
+                if len(lines) < 2:
+                    continue
+                if not self.add(*lines):
+                    sys.stderr.write('ignore duplicate %s\n' % lines[1])
+                continue
+            lines = line.split(':')
+            if len(lines) >= 2:
+                self.options.setdefault(lines[0].strip(), lines[1].strip())
+        return self
+
+    @classmethod
+    def load(cls, path):
+        cpiolist = open(path, 'r')
+        self = cls.parse(cpiolist)
+        cpiolist.close()
+        return self
+
+    def dump(self, output):
+        for key, value in self.options.items():
+            output.write('%s:%s\n' % (key, value))
+        for entry in self.entries.values():
+            output.write('%s\n' % entry)
+
+    def option(self, key, default=None):
+        return self.options.get(key, default)
+
+    def add(self, type, name, *args):
+        ''' append an entry, return False if name is already listed. '''
+        entry = CpioEntry(type, name, *args)
+        if entry.name in self.entries:
+            return False
+        self.entries[entry.name] = entry
+        return True
+
+    def replace(self, type, name, *args):
+        ''' set the entry of name, in place if listed, else appended. '''
+        entry = CpioEntry(type, name, *args)
+        self.entries[entry.name] = entry
+
+    def remove(self, name):
+        del self.entries[name.replace(os.sep, '/')]
+
+    def sort(self):
+        ''' order entries by path, every directory before its content. '''
+        items = sorted(self.entries.items(), key=lambda x: x[0].split('/'))
+        self.entries = collections.OrderedDict(items)
+
+    def digest(self, options=()):
+        ''' sha1 of what write_cpio makes of the list: the named options,
+            then every entry in order with its stored mode and, for a file,
+            the sha1 of its content instead of its path.
+        '''
+        sha = hashlib.sha1()
+        for key in options:
+            sha.update(('%s:%s\n' % (key, self.option(key, ''))).encode('utf-8'))
+        for entry in self.entries.values():
+            args = list(entry.args)
+            if entry.type == 'file' and len(args) >= 2:
+                mode = cpio_file_mode(entry.name, args[1])
+                path = args[0]
+                args = [os.path.lexists(path) and digest_file(path) or '-', oct(mode)]
+            sha.update(('%s %s %s\n' % (entry.type, entry.name, ' '.join(args))).encode('utf-8'))
+        return sha.hexdigest()
+
+    def get(self, name):
+        return self.entries.get(name.replace(os.sep, '/'))
+
+    def __contains__(self, name):
+        return name.replace(os.sep, '/') in self.entries
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+def cpio_header(ino, name, mode=0, filesize=0, nlink=1):
+    ''' newc header of one entry, its name and padding, as android writes
+        them. return bytes
+    '''
+    namesize = len(name) + 1
+    header = CPIO_NEWC % (
+        ino,        # Android自300000递增 # ino normally only for hardlink
+        mode,
+        0, 0,       # uid, gid set to 0
+        nlink,      # 在Android中恒为1而非nlink, hardlinks aside
+        0,          # timestamp set to 0
+        filesize,
+        0, 0,       # 在Android中为(0, 0) 而非 (3, 1)
+        0, 0,       # dont support rmajor, rminor
+        namesize,
+        0)          # chksum always be 0
+    return b''.join((header.encode('latin'), name.encode('latin'), b'\x00',
+                     bytes((~(namesize + 110) + 1) & 3)))
+
+def find_cpio_links(cpiolist):
+    ''' group the regular files of cpiolist (CpioList) with the same mode
+        and content, only files of the same size are hashed.
+        return {name: (first name, group size), ...} of grouped files
+    '''
+    candidates = collections.defaultdict(list)
+    for entry in cpiolist:
+        if entry.type != 'file' or len(entry.args) < 2:
+            continue
+        path = entry.args[0]
+        if os.path.isfile(path):
+            mode = cpio_file_mode(entry.name, entry.args[1])
+            candidates[(mode, os.path.getsize(path))].append(entry)
+
+    links = {}
+    for entries in candidates.values():
+        if len(entries) < 2:
+            continue
+        groups = collections.defaultdict(list)
+        for entry in entries:
+            groups[digest_file(entry.args[0])].append(entry.name)
+        for names in groups.values():
+            if len(names) > 1:
+                for name in names:
+                    links[name] = (names[0], len(names))
+    return links
+
+def cpio_file_mode(name, mode):
+    ''' mode of a file entry as write_cpio stores it. '''
+    if os.path.split(name)[1] in ('su', 'busybox'):
+        mode = '4555'
+    return int(mode, 8) | S_IFREG
+
+def write_cpio(cpiolist, output, dedup=False):
     ''' generate cpio from cpiolist.
-        cpiolist: file object
+        cpiolist: CpioList or file object
         output: file object
+        dedup: store regular files with the same mode and content once,
+               as a newc hardlink group: one ino, nlink set, the body
+               with the first link and none with the others
     '''
 
-    padding = lambda x, y: struct.pack('%ds' % ((~x + 1) & (y - 1)), '')
+    padding = lambda x, y: bytes((~x + 1) & (y - 1))
+    chunk_size = 1 << 20
+    written = 0
+    links = {}
+    inodes = {}
+    saved = 0
 
     def write_cpio_header(output, ino, name, mode=0, nlink=1, filesize=0):
-        namesize = len(name) + 1
-        latin = lambda x: x.encode('latin')
-        output.write(latin('070701'))
-        output.write(latin('%08x' % ino)) # Android自300000递增 # ino normally only for hardlink
-
-        output.write(latin('%08x' % mode))
-        output.write(latin('%08x%08x' % (0, 0))) # uid, gid set to 0
-        output.write(latin('%08x' % 1)) # 在Android中恒为1而非nlink
-        output.write(latin('%08x' % 0)) # timestamp set to 0
-        output.write(latin('%08x' % filesize))
-        output.write(latin('%08x%08x' % (0, 0))) # 在Android中为(0, 0) 而非 (3, 1)
-        output.write(latin('%08x%08x' % (0, 0))) # dont support rmajor, rminor
-        output.write(latin('%08x' % namesize))
-        output.write(latin('%08x' % 0)) # chksum always be 0
-        output.write(latin(name))
-        output.write(struct.pack('1s', ''))
-        output.write(padding(namesize + 110, 4))
+        nonlocal written
+        data = cpio_header(ino, name, mode, filesize)
+        output.write(data)
+        written += len(data)
 
     def cpio_mkfile(output, ino, name, path, mode, *kw):
-        if os.path.split(name)[1] in ('su', 'busybox'):
-            mode = '4555'
-        mode = int(mode, 8) | S_IFREG
+        nonlocal written, saved
+        mode = cpio_file_mode(name, mode)
         if os.path.lexists(path):
             filesize = os.path.getsize(path)
-            write_cpio_header(output, ino, name, mode, 1, filesize)
+            if name in links:
+                first, nlink = links[name]
+                if first != name:
+                    data = cpio_header(inodes[first], name, mode, 0, nlink)
+                    output.write(data)
+                    written += len(data)
+                    saved += filesize
+                    return
+                inodes[name] = ino
+                data = cpio_header(ino, name, mode, filesize, nlink)
+                output.write(data)
+                written += len(data)
+            else:
+                write_cpio_header(output, ino, name, mode, 1, filesize)
+            # bounded chunks, a large blob is never held whole
             tmp = open(path, 'rb')
-            output.write(tmp.read())
+            remain = filesize
+            while remain > 0:
+                data = tmp.read(min(chunk_size, remain))
+                assert data, '%s shrank while writing' % path
+                output.write(data)
+                remain -= len(data)
             tmp.close()
-            output.write(padding(filesize, 4))
+            tail = padding(filesize, 4)
+            output.write(tail)
+            written += filesize + len(tail)
         else:
             sys.stderr.write('not found file %s, skip it\n' % path)
 
@@ -895,11 +1766,14 @@ def write_cpio(cpiolist, output):
         write_cpio_header(output, ino, name, mode, 2, 0)
 
     def cpio_mkslink(output, ino, name, path, mode='777', *kw):
+        nonlocal written
         mode = int(mode, 8) | S_IFLNK
         filesize = len(path)
         write_cpio_header(output, ino, name, mode, 1, filesize)
-        output.write(path)
-        output.write(padding(filesize, 4))
+        tail = padding(filesize, 4)
+        output.write(path.encode('latin'))
+        output.write(tail)
+        written += filesize + len(tail)
 
     def cpio_mknod(output, ino, *kw):
         sys.stderr.write('nod is not implemented\n')
@@ -918,7 +1792,13 @@ def write_cpio(cpiolist, output):
         if hasattr(output, 'tell'):
             output.write(padding(output.tell(), 512))
 
-    files = []
+    if not isinstance(cpiolist, CpioList):
+        info = cpiolist
+        cpiolist = CpioList.parse(info)
+        info.close()
+    if dedup:
+        links = find_cpio_links(cpiolist)
+
     functions = {'dir': cpio_mkdir,
                  'file': cpio_mkfile,
                  'slink': cpio_mkslink,
@@ -926,33 +1806,24 @@ def write_cpio(cpiolist, output):
                  'pipe': cpio_mkpipe,
                  'sock': cpio_mksock}
     next_inode = 300000
-    while True:
-        line = cpiolist.readline()
-        if not line:
-            break
-        lines = line.split()
-        if len(lines) < 1 or lines[0] == '#':
-            continue
-        function = functions.get(lines[0])
-        if not function:
-            continue
-        lines.pop(0)
-        lines[0] = lines[0].replace(os.sep, '/') # if any
-        if lines[0] in files:
-            sys.stderr.write('ignore duplicate %s\n' % lines[0])
-            continue
-        files.append(lines[0])
-        function(output, next_inode, *lines)
+    begin = time.time()
+    for entry in cpiolist:
+        functions[entry.type](output, next_inode, entry.name, *entry.args)
         next_inode += 1
 
     # for extra in ['/tmp', '/mnt']:
-    #    if extra not in files:
+    #    if extra not in cpiolist:
     #        sys.stderr.write('add extra %s\n' % extra)
     #        cpio_mkdir(output, extra)
 
     cpio_tailer(output, next_inode)
-    cpiolist.close()
     output.close()
+    elapsed = max(time.time() - begin, 1e-6)
+    sys.stderr.write('cpio: %d entries, %d bytes in %.3fs (%.1f MB/s)\n' % (
+                     next_inode - 300000, written, elapsed, written / elapsed / 1e6))
+    if dedup:
+        sys.stderr.write('dedup: %d files in %d hardlink groups, %d bytes saved\n' % (
+                         len(links), len(set(x[0] for x in links.values())), saved))
 
 def parse_yaffs2(image, directory):
     ''' parse yaffs2 image.
@@ -1044,15 +1915,510 @@ def parse_yaffs2(image, directory):
 from gzip import GzipFile
 class CPIOGZIP(GzipFile):
     # dont write filename
-    def _write_gzip_header(self):
+    def _write_gzip_header(self, compresslevel=None):
         self.fileobj.write(struct.pack('4B', 0x1f, 0x8b, 0x08, 0x00))
-        self.fileobj.write(struct.pack('4s', ''))
+        self.fileobj.write(struct.pack('4s', b''))
         self.fileobj.write(struct.pack('2B', 0x00, 0x03))
 
     # don't check crc and length
     def _read_eof(self):
         pass
 
+class ParallelCPIOGZIP(object):
+    ''' write-only CPIOGZIP that deflates 128K blocks on a thread pool,
+        zlib releases the GIL while compressing.
+
+        every block is primed with the 32K of input before it and ends on
+        a sync flush, the last one finishes the stream, so the blocks join
+        into one ordinary deflate stream inside one gzip member with the
+        same stripped header as CPIOGZIP. tell() is the uncompressed
+        position, like GzipFile, for the cpio trailer padding.
+    '''
+
+    BLOCK_SIZE = 128 * 1024
+    DICT_SIZE = 32 * 1024
+
+    def __init__(self, fileobj, compresslevel=6, threads=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.dictionary = b''
+        self.crc = 0
+        self.size = 0
+        self.fileobj.write(struct.pack('4B', 0x1f, 0x8b, 0x08, 0x00))
+        self.fileobj.write(struct.pack('4s', b''))
+        self.fileobj.write(struct.pack('2B', 0x00, 0x03))
+
+    def _deflate(self, block, dictionary, finish):
+        if dictionary:
+            c = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                 zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+        else:
+            c = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return c.compress(block) + c.flush(finish and zlib.Z_FINISH or zlib.Z_SYNC_FLUSH)
+
+    def _submit(self, block, finish=False):
+        self.crc = zlib.crc32(block, self.crc)
+        self.pending.append(self.pool.submit(self._deflate, block, self.dictionary, finish))
+        self.dictionary = block[-self.DICT_SIZE:]
+        # bounded, keep memory flat on large ramdisks
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.BLOCK_SIZE:
+            self._submit(bytes(self.buffer[:self.BLOCK_SIZE]))
+            del self.buffer[:self.BLOCK_SIZE]
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        if self.pool is None:
+            return
+        self._submit(bytes(self.buffer), True)
+        self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.fileobj.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+        self.pool.shutdown()
+        self.pool = None
+
+def lz4_block_decompress(src):
+    ''' decode one lz4 block, pure python fallback for python-lz4. '''
+    dst = bytearray()
+    i = 0
+    n = len(src)
+    while i < n:
+        token = src[i]
+        i += 1
+        length = token >> 4
+        if length == 15:
+            while True:
+                byte = src[i]
+                i += 1
+                length += byte
+                if byte != 255:
+                    break
+        dst += src[i:i + length]
+        i += length
+        if i >= n:
+            break
+
+        offset = src[i] | (src[i + 1] << 8)
+        i += 2
+        length = token & 15
+        if length == 15:
+            while True:
+                byte = src[i]
+                i += 1
+                length += byte
+                if byte != 255:
+                    break
+        length += 4
+        start = len(dst) - offset
+        if offset == 0 or start < 0:
+            raise IOError('corrupt lz4 block')
+        if offset >= length:
+            dst += dst[start:start + length]
+        else:
+            # overlapping match repeats the last offset bytes
+            dst += (dst[start:] * (length // offset + 1))[:length]
+    return bytes(dst)
+
+class LZ4LegacyFile(object):
+    ''' lz4 legacy format (lz4 -l, the kernel's unlz4) as a stream.
+        magic, then blocks of 8M input each stored as size + lz4 block.
+
+        reading holds one block at a time and decodes with python-lz4
+        when it is installed, in pure python otherwise. writing needs
+        python-lz4, compresslevel 9 selects high compression.
+    '''
+
+    MAGIC = 0x184c2102
+    BLOCK_SIZE = 8 << 20
+
+    def __init__(self, fileobj, mode='rb', compresslevel=9):
+        try: import lz4.block as lz4block
+        except ImportError: lz4block = None
+        self.lz4block = lz4block
+        self.fileobj = fileobj
+        self.mode = mode
+        self.compresslevel = compresslevel
+        self.buffer = b''
+        self.offset = 0
+        self.size = 0
+        self.last = False
+
+        if 'w' in mode:
+            if lz4block is None:
+                raise SystemExit('Please Install python-lz4 to write lz4 ramdisks')
+            self.buffer = bytearray()
+            fileobj.write(struct.pack('<I', self.MAGIC))
+        else:
+            magic, = struct.unpack('<I', fileobj.read(4))
+            assert magic == self.MAGIC, 'invalid lz4 legacy'
+
+    def _read_block(self):
+        # only the last block is short, anything after it is not ours
+        if self.last:
+            return False
+        while True:
+            data = self.fileobj.read(4)
+            if len(data) < 4:
+                return False
+            size, = struct.unpack('<I', data)
+            if size == self.MAGIC:  # next concatenated stream
+                continue
+            if size == 0:
+                return False
+            data = self.fileobj.read(size)
+            if self.lz4block is not None:
+                self.buffer = self.lz4block.decompress(data, uncompressed_size=self.BLOCK_SIZE)
+            else:
+                self.buffer = lz4_block_decompress(data)
+            self.offset = 0
+            self.last = len(self.buffer) < self.BLOCK_SIZE
+            return True
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self.offset >= len(self.buffer):
+                if not self._read_block():
+                    break
+                continue
+            if size < 0:
+                data = self.buffer[self.offset:]
+            else:
+                data = self.buffer[self.offset:self.offset + size]
+                size -= len(data)
+            self.offset += len(data)
+            chunks.append(data)
+        data = b''.join(chunks)
+        self.size += len(data)
+        return data
+
+    def _write_block(self, data):
+        if self.compresslevel >= 9:
+            data = self.lz4block.compress(data, mode='high_compression', store_size=False)
+        else:
+            data = self.lz4block.compress(data, store_size=False)
+        self.fileobj.write(struct.pack('<I', len(data)))
+        self.fileobj.write(data)
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:self.BLOCK_SIZE]))
+            del self.buffer[:self.BLOCK_SIZE]
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        if 'w' in self.mode and self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+
+class BufferReader(object):
+    ''' read-only file object over a memoryview, without copying it. '''
+
+    def __init__(self, view, offset=0):
+        self.view = view
+        self.pos = offset
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.view) - self.pos
+        data = bytes(self.view[self.pos:self.pos + size])
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.view)
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.view = None
+
+class LzopDecompressor(object):
+    ''' lzop (lzop -c, the kernel's unlzo) with the interface of
+        zlib.decompressobj: decompress(data), eof, unused_data.
+        input is buffered until a whole block is in, compressed blocks
+        are decoded with python-lzo.
+    '''
+
+    MAGIC = b'\x89LZO\x00\r\n\x1a\n'
+
+    def __init__(self):
+        import lzo
+        self.lzo = lzo
+        self.buffer = b''
+        self.flags = None
+        self.eof = False
+        self.unused_data = b''
+
+    def _header(self):
+        # the size of the file header, None while it is not all buffered
+        data = self.buffer
+        if len(data) < 11:
+            return None
+        assert data[:9] == self.MAGIC, 'invalid lzop'
+        version, = struct.unpack_from('>H', data, 9)
+        new = version >= 0x0940
+        pos = 13 + (2 if new else 0) + (2 if new else 1)  # versions, method, level
+        if len(data) < pos + 4:
+            return None
+        flags, = struct.unpack_from('>I', data, pos)
+        pos += 4 + (4 if flags & 0x800 else 0)            # filter
+        pos += 8 + (4 if new else 0)                      # mode, mtime
+        if len(data) < pos + 1:
+            return None
+        pos += 1 + data[pos] + 4                          # name, checksum
+        if flags & 0x40:                                  # extra field
+            if len(data) < pos + 4:
+                return None
+            pos += 4 + struct.unpack_from('>I', data, pos)[0] + 4
+        if len(data) < pos:
+            return None
+        self.flags = flags
+        return pos
+
+    def decompress(self, data):
+        if self.eof:
+            self.unused_data += bytes(data)
+            return b''
+        self.buffer += bytes(data)
+        pos = 0
+        if self.flags is None:
+            pos = self._header()
+            if pos is None:
+                return b''
+
+        chunks = []
+        while len(self.buffer) >= pos + 4:
+            dst_len, = struct.unpack_from('>I', self.buffer, pos)
+            if dst_len == 0:
+                self.eof = True
+                self.unused_data = self.buffer[pos + 4:]
+                pos = len(self.buffer)
+                break
+            if len(self.buffer) < pos + 8:
+                break
+            src_len, = struct.unpack_from('>I', self.buffer, pos + 4)
+            if src_len > dst_len or dst_len > 64 << 20:
+                raise IOError('invalid lzop block')
+            checksums = bin(self.flags & 0x101).count('1')
+            if src_len < dst_len:
+                checksums += bin(self.flags & 0x202).count('1')
+            start = pos + 8 + 4 * checksums
+            if len(self.buffer) < start + src_len:
+                break
+            block = self.buffer[start:start + src_len]
+            if src_len < dst_len:
+                try:
+                    block = self.lzo.decompress(block, False, dst_len)
+                except self.lzo.error as e:
+                    raise IOError('invalid lzop block: %s' % e)
+            chunks.append(block)
+            pos = start + src_len
+        self.buffer = self.buffer[pos:]
+        return b''.join(chunks)
+
+class ZstdDecompressor(object):
+    ''' one zstd frame with python-zstandard, with the interface of
+        zlib.decompressobj.
+    '''
+
+    def __init__(self):
+        import zstandard
+        self.zstandard = zstandard
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        try:
+            return self.decompressor.decompress(data)
+        except self.zstandard.ZstdError as e:
+            raise IOError('invalid zstd: %s' % e)
+
+    eof = property(lambda self: self.decompressor.eof)
+    unused_data = property(lambda self: self.decompressor.unused_data)
+
+# ramdisk compression formats by magic,
+# (name, magic, open for reading(fileobj), open for writing(fileobj, level))
+RAMDISK_FORMATS = [
+    ('gzip', b'\x1f\x8b\x08',
+        lambda f: CPIOGZIP(None, 'rb', 6, f),
+        lambda f, level: CPIOGZIP(None, 'wb', level, f)),
+    ('lz4', struct.pack('<I', LZ4LegacyFile.MAGIC),
+        lambda f: LZ4LegacyFile(f, 'rb'),
+        lambda f, level: LZ4LegacyFile(f, 'wb', level)),
+    # the kernel only checks crc32 in xz
+    ('xz', b'\xfd7zXZ\x00',
+        lambda f: lzma.LZMAFile(f, 'rb', format=lzma.FORMAT_XZ),
+        lambda f, level: lzma.LZMAFile(f, 'wb', format=lzma.FORMAT_XZ,
+                                       check=lzma.CHECK_CRC32, preset=level)),
+    ('lzma', b'\x5d\x00\x00',
+        lambda f: lzma.LZMAFile(f, 'rb', format=lzma.FORMAT_ALONE),
+        lambda f, level: lzma.LZMAFile(f, 'wb', format=lzma.FORMAT_ALONE, preset=level)),
+    ('bzip2', b'BZh',
+        lambda f: bz2.BZ2File(f, 'rb'),
+        lambda f, level: bz2.BZ2File(f, 'wb', compresslevel=max(level, 1))),
+]
+
+def ramdisk_format(magic):
+    ''' return the RAMDISK_FORMATS entry magic starts with, or None. '''
+    for format in RAMDISK_FORMATS:
+        if magic.startswith(format[1]):
+            return format
+    return None
+
+# compressed kernel payloads, located with one regex pass over the kernel
+KERNEL_MAGIC = re.compile(rb'(?P<gzip>\x1f\x8b\x08)|(?P<xz>\xfd7zXZ\x00)|'
+                          rb'(?P<lz4>\x02\x21\x4c\x18)|(?P<lzma>\x5d\x00\x00)|'
+                          rb'(?P<bzip2>BZh[1-9]1AY&SY)|(?P<lzo>\x89LZO\x00)|'
+                          rb'(?P<zstd>\x28\xb5\x2f\xfd)')
+KERNEL_VERSION = re.compile(rb'Linux version [^\x00\n]*')
+# the optional modules some kernel payloads need
+KERNEL_MODULES = {'lzo': 'python-lzo', 'zstd': 'zstandard'}
+# what a payload that is not one raises while decoding
+KERNEL_ERRORS = (IOError, EOFError, ValueError, IndexError, AssertionError,
+                 struct.error, zlib.error, lzma.LZMAError)
+
+def iter_payload(view, offset, name, chunk=1 << 20):
+    ''' yield the decompressed pieces of the name stream at offset of view,
+        feeding at most chunk bytes of input at a time. the generator
+        returns the compressed size.
+    '''
+    if name == 'lz4':
+        reader = BufferReader(view, offset)
+        lz4 = LZ4LegacyFile(reader)
+        while True:
+            data = lz4.read(chunk)
+            if not data:
+                return reader.tell() - offset
+            yield data
+
+    decompressors = {'gzip': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+                     'xz': lambda: lzma.LZMADecompressor(lzma.FORMAT_XZ),
+                     'lzma': lambda: lzma.LZMADecompressor(lzma.FORMAT_ALONE),
+                     'bzip2': bz2.BZ2Decompressor,
+                     'lzo': LzopDecompressor,
+                     'zstd': ZstdDecompressor}
+    if name not in decompressors:
+        raise IOError('%s payload is not supported' % name)
+    decompressor = decompressors[name]()
+    pos = offset
+    while pos < len(view):
+        data = decompressor.decompress(view[pos:pos + chunk])
+        pos = min(pos + chunk, len(view))
+        if data:
+            yield data
+        if decompressor.eof:
+            return pos - offset - len(decompressor.unused_data)
+    raise IOError('truncated %s payload' % name)
+
+def analyze_kernel(buf, output=None, probe_size=1 << 20):
+    ''' identify the kernel in buf (mmap, bytes or memoryview): a plain
+        Image, or a zImage / Image.gz with a gzip, lz4, xz, lzma, bzip2,
+        lzo (python-lzo) or zstd (zstandard) payload.
+
+        the candidates are tried in file order, the first one giving
+        probe_size bytes (or its whole stream) without error is taken and
+        streamed to output, so only the probe is ever held in memory.
+        a stream failing later is cut from output and the next candidate
+        tried. SystemExit if the only payload needs a missing module.
+
+        return dict(compression, offset, compressed_size, size, version)
+    '''
+    def version_in(data):
+        match = KERNEL_VERSION.search(data)
+        return match and match.group().decode('latin')
+
+    with memoryview(buf) as view:
+        # arm64 Image and vmlinux carry their own magic
+        plain = bytes(view[0x38:0x3c]) == b'ARMd' or bytes(view[:4]) == b'\x7fELF'
+        match = KERNEL_VERSION.search(view)
+        if plain and match:
+            if output is not None:
+                output.write(view)
+            return dict(compression='none', offset=0, compressed_size=len(view),
+                        size=len(view), version=match.group().decode('latin'))
+
+        # a payload holding a literal banner (lz4) starts before it,
+        # a plain Image only has embedded streams (ikconfig) after it
+        end = match.start() if match else len(view)
+        missing = None
+        start = output.tell() if output is not None else 0
+        for match in KERNEL_MAGIC.finditer(view, 0, end):
+            name, offset = match.lastgroup, match.start()
+            payload = iter_payload(view, offset, name)
+            probe, probed = [], 0
+            try:
+                while probed < probe_size:
+                    data = next(payload)
+                    probe.append(data)
+                    probed += len(data)
+            except StopIteration as done:
+                compressed_size = done.value
+                payload = None
+            except ImportError:
+                missing = missing or (name, offset)
+                continue
+            except KERNEL_ERRORS:
+                continue
+
+            sizes = []
+            def rest():
+                sizes.append((yield from payload))
+
+            size, tail, version = 0, b'', None
+            try:
+                for data in itertools.chain(probe, rest() if payload else ()):
+                    if version is None:
+                        # the version string may span two pieces
+                        version = version_in(tail + data)
+                        tail = data[-256:]
+                    size += len(data)
+                    if output is not None:
+                        output.write(data)
+            except KERNEL_ERRORS:
+                if output is not None:
+                    output.seek(start)
+                    output.truncate()
+                continue
+            if payload:
+                compressed_size = sizes[0]
+            return dict(compression=name, offset=offset, compressed_size=compressed_size,
+                        size=size, version=version)
+
+        if missing:
+            raise SystemExit('%s kernel payload at 0x%x: Please Install %s' % (missing[0],
+                             missing[1], KERNEL_MODULES[missing[0]]))
+        if end < len(view):
+            if output is not None:
+                output.write(view)
+            return dict(compression='none', offset=0, compressed_size=len(view),
+                        size=len(view), version=version_in(view))
+        return dict(compression='unknown', offset=None, compressed_size=None,
+                    size=None, version=None)
+
 def parse_rle(rle, raw):
     ''' convert 565-rle format to raw file.
 
@@ -1150,10 +2516,15 @@ def write_565(raw, rle):
     return total
 
 __all__ = [ 'parse_updata',
+            'list_updata',
+            'write_updata',
             'parse_bootimg',
             'write_bootimg',
+            'BootImgHeader',
+            'BootImage',
             'parse_cpio',
             'write_cpio',
+            'CpioList',
             'parse_yaffs2',
             'parse_rle',
             'write_rle',
@@ -1248,63 +2619,30 @@ def repack_bootimg(_base=None, _cmdline=None, _page_size=None, _padding_size=Non
 
     sys.stderr.write('arguments: [cpiolist file]\n')
     sys.stderr.write('cpiolist file: %s\n' % cpiolist)
-    sys.stderr.write('output: ramdisk.cpio.gz\n')
+    ramdisk = build_ramdisk(cpiolist)
 
-    tmp = open('ramdisk.cpio.gz.tmp', 'wb')
-    out = open('ramdisk.cpio.gz', 'wb')
-    cpiogz = tmp
-    
-    info = open(cpiolist, 'r')
-    compress_level = 6
-    
-    off2 = info.tell()
-    info.seek(0, 0)
-    for line in info.readlines():
-        lines = line.split(':')
-        if len(lines) < 1 or lines[0][0] == '#':
-            continue;
-        if lines[0].strip() == 'compress_level':
-            compress_level = int(lines[1], 10)
-            break
-    info.seek(off2, 0)
+    img = BootImage()
+    if _base is not None:
+        img.base = int(_base, 16)
 
-    if compress_level <= 0:
-        cpiogz = tmp
-    else:
-        if compress_level > 9:
-            compress_level = 9
-        cpiogz = CPIOGZIP(None, 'wb', compress_level, tmp)
-    sys.stderr.write('compress_level: %d\n' % compress_level)
-    write_cpio(info, cpiogz)
-    #cpiogz.close()
-    tmp.close()
-    #info.close()
+    if _cmdline is not None:
+        img.cmdline = _cmdline
 
-    tmp = open('ramdisk.cpio.gz.tmp', 'rb')
-    info = open(cpiolist, 'r')
-    if try_add_head(tmp, out, info):
-        while True:
-            data = tmp.read(65536)
-            if not data:
-                break
-            out.write(data)
-        tmp.close()
-        out.close()
-        os.remove('ramdisk.cpio.gz.tmp')
-    else:
-        tmp.close()
-        out.close()
-        os.remove('ramdisk.cpio.gz')
-        os.rename('ramdisk.cpio.gz.tmp', 'ramdisk.cpio.gz')
-    info.close()
+    if _page_size is not None:
+        img.page_size = int(str(_page_size))
 
-    global base, ramdisk_addr, second_addr, tags_addr, name, cmdline, page_size, padding_size
-    if os.path.exists('ramdisk.cpio.gz'):
-        ramdisk = 'ramdisk.cpio.gz'
-    elif os.path.exists('ramdisk'):
-        ramdisk = 'ramdisk'
+    if _padding_size is not None:
+        img.padding_size = int(str(_padding_size))
+
+    if os.path.exists('bootinfo.txt'):
+        bootinfo = open('bootinfo.txt', 'r')
+        img.read_bootinfo(bootinfo)
+        bootinfo.close()
+
+    if os.path.exists('kernel.gz'):
+        kernel = 'kernel.gz'
     else:
-        ramdisk = 'ramdisk.gz'
+        kernel = 'kernel'
 
     if os.path.exists('second.gz'):
         second = 'second.gz'
@@ -1320,89 +2658,49 @@ def repack_bootimg(_base=None, _cmdline=None, _page_size=None, _padding_size=Non
     else:
         dt_image = ''
 
-    if _base is not None:
-        base = int(_base, 16)
-
-    if _cmdline is not None:
-        cmdline = _cmdline
-
-    if _page_size is not None:
-        page_size = int(str(_page_size))
-
-    if _padding_size is not None:
-        padding_size = int(str(_padding_size))
-
-    if os.path.exists('bootinfo.txt'):
-        bootinfo = open('bootinfo.txt', 'r')
-        parse_bootinfo(bootinfo)
-        bootinfo.close()
+    # mtk images are written back over boot.img, like add_head does
+    output = img.mtk_name is None and 'boot-new.img' or 'boot.img'
 
     sys.stderr.write('arguments: [base] [cmdline] [page_size] [padding_size]\n')
-    sys.stderr.write('kernel: kernel\n')
-    sys.stderr.write('ramdisk: %s\n' % ramdisk)
+    sys.stderr.write('kernel: %s\n' % kernel)
+    sys.stderr.write('ramdisk: %s (%d bytes)\n' % (cpiolist, len(ramdisk)))
     sys.stderr.write('second: %s\n' % second)
     sys.stderr.write('dt_image: %s\n' % dt_image)
-    sys.stderr.write('base: 0x%x\n' % base)
-    sys.stderr.write('ramdisk_addr: 0x%x\n' % ramdisk_addr)
-    sys.stderr.write('second_addr: 0x%x\n' % second_addr)
-    sys.stderr.write('tags_addr: 0x%x\n' % tags_addr)
-    sys.stderr.write('name: %s\n' % name)
-    sys.stderr.write('cmdline: %s\n' % cmdline)
-    sys.stderr.write('page_size: %d\n' % page_size)
-    sys.stderr.write('padding_size: %d\n' % padding_size)
-    sys.stderr.write('output: boot-new.img\n')
-
-    tmp = open('boot.img.tmp', 'wb')
-    options = { 'base': base,
-                'ramdisk_addr': ramdisk_addr,
-                'second_addr': second_addr,
-                'tags_addr': tags_addr,
-                'name': name,
-                'cmdline': cmdline,
-                'output': tmp,
-                'kernel': open('kernel', 'rb'),
-                'ramdisk': open(ramdisk, 'rb'),
-                'second': second and open(second, 'rb') or None,
-                'page_size': page_size,
-                'padding_size': padding_size,
-                'dt_image': dt_image and open(dt_image, 'rb') or None,
-                }
-
-    write_bootimg(**options)
+    sys.stderr.write('base: 0x%x\n' % img.base)
+    sys.stderr.write('ramdisk_addr: 0x%x\n' % img.ramdisk_addr)
+    sys.stderr.write('second_addr: 0x%x\n' % img.second_addr)
+    sys.stderr.write('tags_addr: 0x%x\n' % img.tags_addr)
+    sys.stderr.write('name: %s\n' % img.name)
+    sys.stderr.write('cmdline: %s\n' % img.cmdline)
+    sys.stderr.write('page_size: %d\n' % img.page_size)
+    sys.stderr.write('padding_size: %d\n' % img.padding_size)
+    sys.stderr.write('output: %s\n' % output)
+
+    img.replace('kernel', open(kernel, 'rb'))
+    img.replace('ramdisk', ramdisk)
+    img.replace('second', second and open(second, 'rb') or None)
+    img.replace('dt_image', dt_image and open(dt_image, 'rb') or None)
+    tmp = open(output, 'wb')
+    img.write(tmp)
     tmp.close()
-    if os.path.exists('bootinfo.txt'):
-        bootinfo = open('bootinfo.txt', 'r')
-        output = open('boot.img', 'wb')
-        tmp = open('boot.img.tmp', 'rb')
-        if try_add_head(tmp, output, bootinfo):
-            bootinfo.close()
-            while True:
-                data = tmp.read(65536)
-                if not data:
-                    break
-                output.write(data)
-            tmp.close()
-            os.remove('boot.img.tmp')
-            out.close()
-            return
-        else:
-            tmp.close()
-            output.close()
-            bootinfo.close()
+    if img.mtk_name is not None:
+        return
+
     os.remove('bootinfo.txt')
     os.remove('boot.img')
     os.remove('cpiolist.txt')
+    if os.path.exists('cpiolist.manifest'):
+        os.remove('cpiolist.manifest')
     if os.path.exists('ramdisk.gz'):
         os.remove('ramdisk.gz')
     if os.path.exists('ramdisk.cpio.gz'):
-        os.remove('ramdisk.cpio.gz')   
-    os.remove('kernel')
+        os.remove('ramdisk.cpio.gz')
+    os.remove(kernel)
     if os.path.exists('dt_image'):
         os.remove('dt_image')
     if os.path.exists('ramdisk'):
         os.remove('ramdisk')
     shutil.rmtree('initrd')
-    os.rename('boot.img.tmp', 'boot-new.img')
 
 def unpack_bootimg(bootimg=None, ramdisk=None, directory=None):
     shutil.copy('boot.img', 'boot-old.img')
@@ -1414,49 +2712,628 @@ def unpack_bootimg(bootimg=None, ramdisk=None, directory=None):
     sys.stderr.write('bootimg file: %s\n' % bootimg)
     sys.stderr.write('output: kernel[.gz] ramdisk[.gz] second[.gz]\n')
     parse_bootimg(open(bootimg, 'rb'))
-	
-    if ramdisk is None:
-        if os.path.exists('ramdisk.gz'):
-            ramdisk = 'ramdisk.gz'
-        elif os.path.exists('ramdisk'):
-            ramdisk = 'ramdisk'
-        elif os.path.exists('ramdisk.cpio.gz'):
-            ramdisk = 'ramdisk.cpio.gz'
+    unpack_ramdisk(ramdisk, directory)
+
+def is_bootimg(path):
+    ''' check for a bootimg/vendor_boot magic, behind a mtk head or not. '''
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return False
+    data = f.read(0x208)
+    f.close()
+    if data[:4] == struct.pack('<I', 0x58881688):
+        data = data[0x200:]
+    return data[:8] in (b'ANDROID!', b'VNDRBOOT')
+
+class SectionCache(object):
+    ''' content-addressed cache of unpacked bootimgs (and of built
+        ramdisks, see build_ramdisk).
+
+        root/index.json     entries {key: {'size', 'atime'}}, hits, misses
+        root/objects/<key>  the unpacked files (sections, initrd, cpiolist)
+
+        key is the sha1 id of write_bootimg, computed from the sections
+        (bootimg_id), so the same firmware build unpacked again on any
+        device is a copy instead of a gzip and cpio decode. the least
+        recently used entries are evicted past max_size bytes.
+    '''
+
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.max_size = max_size
+        if not os.path.isdir(self.objects):
+            os.makedirs(self.objects)
+
+    def _lock(self):
+        # O_EXCL lock file, works for pool workers and on windows
+        path = os.path.join(self.root, 'index.lock')
+        begin = time.time()
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return path
+            except OSError:
+                if time.time() - begin > 30:
+                    os.remove(path) # stale, owner died
+                time.sleep(0.01)
+
+    def _evict(self, index):
+        ''' drop least recently used entries past max_size. '''
+        entries = index['entries']
+        total = sum(x['size'] for x in entries.values())
+        for old in sorted(entries, key=lambda x: entries[x]['atime']):
+            if total <= index['max_size']:
+                break
+            total -= entries.pop(old)['size']
+            shutil.rmtree(os.path.join(self.objects, old), True)
+
+    def _update(self, function):
+        ''' run function(index) under the lock, evict and save index. '''
+        lock = self._lock()
+        try:
+            path = os.path.join(self.root, 'index.json')
+            try:
+                index = json.load(open(path, 'r'))
+            except (IOError, ValueError):
+                index = {'entries': {}, 'hits': 0, 'misses': 0, 'max_size': 2 << 30}
+            if self.max_size is not None:
+                index['max_size'] = self.max_size
+            self._evict(index)
+            result = function(index)
+            self._evict(index)
+            tmp = '%s.%d' % (path, os.getpid())
+            json.dump(index, open(tmp, 'w'), indent=1, sort_keys=True)
+            os.replace(tmp, path)
+            return result
+        finally:
+            os.remove(lock)
+
+    def get(self, key, directory):
+        ''' copy entry key into directory, return False on a miss. '''
+        def lookup(index):
+            entry = index['entries'].get(key)
+            if entry is None or not os.path.isdir(os.path.join(self.objects, key)):
+                index['misses'] += 1
+                return False
+            entry['atime'] = time.time()
+            index['hits'] += 1
+            return True
+
+        if not self._update(lookup):
+            return False
+        source = os.path.join(self.objects, key)
+        for name in os.listdir(source):
+            path = os.path.join(source, name)
+            if os.path.isdir(path):
+                shutil.copytree(path, os.path.join(directory, name), symlinks=True)
+            else:
+                shutil.copy(path, directory)
+        return True
+
+    def put(self, key, directory, names):
+        ''' store names (files or trees) of directory as entry key. '''
+        tmp = os.path.join(self.objects, '%s.%d.tmp' % (key, os.getpid()))
+        os.makedirs(tmp)
+        size = 0
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                shutil.copytree(path, os.path.join(tmp, name), symlinks=True)
+                for root, dirs, files in os.walk(path):
+                    size += sum(os.lstat(os.path.join(root, x)).st_size for x in files)
+            else:
+                shutil.copy(path, tmp)
+                size += os.path.getsize(path)
+
+        def insert(index):
+            target = os.path.join(self.objects, key)
+            if key in index['entries'] or os.path.exists(target):
+                shutil.rmtree(tmp)
+                return
+            os.rename(tmp, target)
+            index['entries'][key] = {'size': size, 'atime': time.time()}
+
+        self._update(insert)
+
+    def stats(self):
+        def read(index):
+            entries = index['entries']
+            return {'entries': len(entries),
+                    'size': sum(x['size'] for x in entries.values()),
+                    'max_size': index['max_size'],
+                    'hits': index['hits'],
+                    'misses': index['misses']}
+        return self._update(read)
+
+def bootimg_id(img):
+    ''' sha1 id over sections and sizes, as write_bootimg computes it. '''
+    sha = hashlib.sha1()
+    for name in ('kernel', 'ramdisk', 'second'):
+        data = img.sections.get(name, b'')
+        sha.update(data)
+        sha.update(struct.pack('<I', len(data)))
+    for name, data in sorted(img.sections.items()):
+        if name not in ('kernel', 'ramdisk', 'second'):
+            sha.update(data)
+            sha.update(struct.pack('<I', len(data)))
+    return sha.hexdigest()
+
+def unpack_bootimg_to(bootimg, directory, cache=None):
+    ''' unpack bootimg (file name) under directory with the layout
+        --unpack-bootimg leaves in cwd, ready for --repack-bootimg there.
+        cache: SectionCache root directory, or None
+        return a summary dict.
+    '''
+    begin = time.time()
+    os.makedirs(directory)
+    imgfile = open(bootimg, 'rb')
+    img = BootImage.load(imgfile)
+
+    bootinfo = open(os.path.join(directory, 'bootinfo.txt'), 'w')
+    img.write_bootinfo(bootinfo)
+    bootinfo.close()
+
+    sizes = []
+    names = []
+    ramdisk = None
+    for name, offset, size, ext in img.header.index():
+        sizes.append((name, size))
+        names.append(name + ext)
+        if name == 'ramdisk':
+            ramdisk = name + ext
+
+    # bootinfo (name, cmdline, addresses) is not part of the key,
+    # it always comes from the header
+    if cache is not None:
+        cache = SectionCache(cache)
+        key = bootimg_id(img)
+        if cache.get(key, directory):
+            img.close()
+            imgfile.close()
+            return {'image': bootimg,
+                    'directory': directory,
+                    'header_version': img.header.header_version,
+                    'base': img.base,
+                    'page_size': img.page_size,
+                    'cmdline': img.cmdline,
+                    'sections': sizes,
+                    'cached': True,
+                    'seconds': time.time() - begin}
+
+    for name, offset, size, ext in img.header.index():
+        output = open(os.path.join(directory, name + ext), 'wb')
+        output.write(img.sections[name])
+        output.close()
+
+    summary = {'image': bootimg,
+               'directory': directory,
+               'header_version': img.header.header_version,
+               'base': img.base,
+               'page_size': img.page_size,
+               'cmdline': img.cmdline,
+               'sections': sizes}
+    img.close()
+    imgfile.close()
+
+    if ramdisk is not None:
+        cpiolist = open(os.path.join(directory, 'cpiolist.txt'), 'w')
+        cpio = open_ramdisk(open(os.path.join(directory, ramdisk), 'rb'), cpiolist)
+        files = parse_cpio(cpio, os.path.join(directory, 'initrd'), cpiolist, 'initrd')
+        write_ramdisk_manifest('cpiolist.manifest', ramdisk, 'cpiolist.txt', files, directory)
+        names += ['initrd', 'cpiolist.txt', 'cpiolist.manifest']
+
+    if cache is not None:
+        cache.put(key, directory, names)
+
+    summary['cached'] = False
+    summary['seconds'] = time.time() - begin
+    return summary
+
+def unpack_bootimg_job(args):
+    # runs in a pool worker, report failures instead of raising them
+    try:
+        return unpack_bootimg_to(*args)
+    except Exception as e:
+        return {'image': args[0], 'directory': args[1], 'error': str(e)}
+
+def unpack_batch(*args):
+    ''' unpack many bootimgs, each into its own directory.
+        arguments: [--jobs N] [--output DIR] [--cache DIR] image|directory ...
+        directories are searched recursively for bootimgs.
+        with --cache, unpacked images are kept in a SectionCache.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    jobs = os.cpu_count() or 1
+    outdir = 'unpacked'
+    cache = None
+    inputs = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '--jobs':
+            jobs = int(args.pop(0))
+        elif arg == '--output':
+            outdir = args.pop(0)
+        elif arg == '--cache':
+            cache = args.pop(0)
         else:
-            ramdisk = 'ramdisk.gz'
+            inputs.append(arg)
 
-    if directory is None:
-        directory = 'initrd'
+    if not inputs:
+        sys.stderr.write('arguments: [--jobs N] [--output DIR] [--cache DIR] image|directory ...\n')
+        return
 
-    sys.stderr.write('arguments: [ramdisk file] [directory]\n')
-    sys.stderr.write('ramdisk file: %s\n' % ramdisk)
-    sys.stderr.write('directory: %s\n' % directory)
-    sys.stderr.write('output: cpiolist.txt\n')
+    # image path -> output directory, named after the path of the image
+    tasks = []
+    for arg in inputs:
+        if os.path.isdir(arg):
+            for root, dirs, files in os.walk(arg):
+                dirs.sort()
+                for file in sorted(files):
+                    path = os.path.join(root, file)
+                    if is_bootimg(path):
+                        tasks.append((path, os.path.relpath(path, arg)))
+        else:
+            tasks.append((arg, os.path.basename(arg)))
+
+    used = set()
+    for i, (path, name) in enumerate(tasks):
+        directory = os.path.join(outdir, name)
+        n = 1
+        while directory in used:
+            n += 1
+            directory = os.path.join(outdir, '%s.%d' % (name, n))
+        if os.path.lexists(directory):
+            raise SystemExit('please remove %s' % directory)
+        used.add(directory)
+        tasks[i] = (path, directory, cache)
+
+    sys.stderr.write('images: %d\n' % len(tasks))
+    sys.stderr.write('jobs: %d\n' % jobs)
+    sys.stderr.write('output: %s\n' % outdir)
+    if cache is not None:
+        sys.stderr.write('cache: %s\n' % cache)
+
+    begin = time.time()
+    if jobs > 1 and len(tasks) > 1:
+        pool = ProcessPoolExecutor(jobs)
+        results = pool.map(unpack_bootimg_job, tasks)
+    else:
+        pool = None
+        results = map(unpack_bootimg_job, tasks)
+
+    failed = 0
+    for result in results:
+        if 'error' in result:
+            failed += 1
+            sys.stdout.write('%s: FAILED %s\n' % (result['image'], result['error']))
+            continue
+        sys.stdout.write('%s -> %s (%.3fs%s)\n' % (result['image'], result['directory'],
+                         result['seconds'], result['cached'] and ', cached' or ''))
+        sys.stdout.write('\theader_version: %d base: 0x%x page_size: %d\n' % (
+                         result['header_version'], result['base'], result['page_size']))
+        sys.stdout.write('\tcmdline: "%s"\n' % result['cmdline'])
+        sys.stdout.write('\t%s\n' % ' '.join('%s: %d' % x for x in result['sections']))
+    if pool is not None:
+        pool.shutdown()
+
+    sys.stderr.write('unpacked %d of %d images in %.3fs\n' % (
+                     len(tasks) - failed, len(tasks), time.time() - begin))
+
+def cache_stats(root=None, max_size=None):
+    ''' report or resize (max_size in MB) a SectionCache. '''
+    if root is None:
+        sys.stderr.write('arguments: cache directory [max size MB]\n')
+        return
+    if max_size is not None:
+        max_size = int(str(max_size)) << 20
+    stats = SectionCache(root, max_size).stats()
+    lookups = stats['hits'] + stats['misses']
+    sys.stdout.write('entries: %d\n' % stats['entries'])
+    sys.stdout.write('size: %d / %d bytes\n' % (stats['size'], stats['max_size']))
+    sys.stdout.write('hits: %d\n' % stats['hits'])
+    sys.stdout.write('misses: %d\n' % stats['misses'])
+    sys.stdout.write('hit rate: %.1f%%\n' % (lookups and 100.0 * stats['hits'] / lookups or 0))
+
+UPDATA_HEADER = struct.Struct('<4sI4s8sII16s16s16s16s2s4s')
+UpdataEntry = collections.namedtuple('UpdataEntry', 'position name boardname date time input unknown '
+                                     'offset header_length crc_offset content_offset content_length')
+
+def list_updata(updata):
+    ''' index UPDATA.APP from its record headers alone, the content of
+        every partition is seeked over, see parse_updata.
+        updata: file object
+        return [UpdataEntry, ...], offsets absolute, crc table at
+        crc_offset up to content_offset
+    '''
+    text = lambda x: x.split(b'\x00', 1)[0].decode('latin')
+    entries = []
+    while True:
+        offset = updata.tell()
+        data = updata.read(4)
+        if not data:
+            break
+        if data == struct.pack('4s', b''):
+            continue
 
-    if os.path.lexists(directory):
-        raise SystemExit('please remove %s' % directory)
+        data += updata.read(94)
+        assert len(data) == 98, 'invalid updata'
+        (   magic, header_length, tag1, boardname, position, content_length,
+            date, time, INPUT, null, unknown, tag2,
+        ) = UPDATA_HEADER.unpack(data)
+        assert magic == b'\x55\xaa\x5a\xa5', 'invalid updata %s' % binascii.hexlify(magic)
+
+        entries.append(UpdataEntry(position, POSITION.get(position), text(boardname),
+                                   text(date), text(time), text(INPUT),
+                                   struct.unpack('!H', unknown)[0], offset, header_length,
+                                   offset + 98, offset + header_length, content_length))
+        padding = (~(header_length + content_length) + 1) & 3
+        updata.seek(offset + header_length + content_length + padding, 0)
+    return entries
 
-    tmp = open(ramdisk, 'rb')
-    cpiolist = open('cpiolist.txt', 'w')
-    check_mtk_head(tmp, cpiolist)
-    pos = tmp.tell()
+def list_updata_file(updata=None, out=None):
+    if updata is None:
+        updata = 'UPDATA.APP'
+    sys.stderr.write('arguments: [updata file] [json file]\n')
+    sys.stderr.write('updata file: %s\n' % updata)
 
-    compress_level = 0
-    magic = tmp.read(6)
-    if magic[:3] == struct.pack('3B', 0x1f, 0x8b, 0x08):
-        tmp.seek(pos, 0)
-        compress_level = 6
-        cpio = CPIOGZIP(None, 'rb', compress_level, tmp)
-    elif magic.decode('latin') == '070701':
-        tmp.seek(pos, 0)
-        cpio = tmp
+    updatafile = open(updata, 'rb')
+    entries = list_updata(updatafile)
+    updatafile.close()
+    data = [x._asdict() for x in entries]
+    if out is None:
+        json.dump(data, sys.stdout, indent=1)
+        sys.stdout.write('\n')
     else:
-        tmp.close()
-        raise IOError('invalid ramdisk')
+        output = open(out, 'w')
+        json.dump(data, output, indent=1)
+        output.close()
+    return entries
 
-    cpiolist.write('compress_level:%d\n' % compress_level)
-    sys.stderr.write('compress: %s\n' % (compress_level > 0))
-    parse_cpio(cpio, directory, cpiolist)
+# serializes seek + read where os.pread is missing (windows)
+range_lock = threading.Lock()
+
+def copy_range(source, offset, length, path):
+    ''' copy length bytes at offset of file descriptor source to a new file
+        path, in the kernel with os.copy_file_range where it works, else
+        with os.pread. the position of source is left alone, so any
+        number of ranges can be copied from it at once.
+    '''
+    output = open(path, 'wb')
+    target = output.fileno()
+    remain = length
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while remain > 0:
+                size = os.copy_file_range(source, target, min(remain, 1 << 30),
+                                          offset + length - remain)
+                if not size:
+                    break
+                remain -= size
+        except OSError:
+            pass # not supported here, the rest goes through pread
+    while remain > 0:
+        position = offset + length - remain
+        size = min(remain, 1 << 20)
+        if hasattr(os, 'pread'):
+            data = os.pread(source, size, position)
+        else:
+            with range_lock:
+                os.lseek(source, position, 0)
+                data = os.read(source, size)
+        if not data:
+            break
+        output.write(data)
+        remain -= len(data)
+    output.close()
+    if remain:
+        raise IOError('%s: %d bytes missing at 0x%x' % (path, remain, offset + length - remain))
+
+def extract_updata(updata, directory='.', only=None, threads=None, debug=False):
+    ''' write the partitions of UPDATA.APP (file name) under directory,
+        several at once, each one a copy_range of the indexed content.
+        without only, directory/updata.json is written for write_updata.
+        only: positions to extract, default all
+        debug: name files 0x<position> and check the crc header first,
+               else POSITION names, 0x<position> for unknown ones
+        return [(UpdataEntry, path), ...]
+    '''
+    updatafile = open(updata, 'rb')
+    entries = list_updata(updatafile)
+    tasks = []
+    for entry in entries:
+        if only is not None and entry.position not in only:
+            continue
+        if debug or entry.name is None:
+            name = '0x%x' % entry.position
+        else:
+            name = entry.name
+        tasks.append((entry, os.path.join(directory, name)))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if only is None:
+        write_updata_manifest(os.path.join(directory, 'updata.json'), entries,
+                              [os.path.basename(x[1]) for x in tasks])
+
+    source = updatafile.fileno()
+    def extract(task):
+        entry, path = task
+        if debug:
+            content = open(updata, 'rb')
+            content.seek(entry.crc_offset, 0)
+            header = content.read(entry.content_offset - entry.crc_offset)
+            for block in range(0, entry.content_length, 1 << 20):
+                data = content.read(min(1 << 20, entry.content_length - block))
+                assert not verify_crc_ccitt(header[block // 2048:], data), \
+                    'bad crc in 0x%x at 0x%x' % (entry.position, block)
+            content.close()
+        copy_range(source, entry.content_offset, entry.content_length, path)
+        sys.stderr.write('0x%x %d bytes -> %s\n' % (entry.position, entry.content_length, path))
+
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(int(str(threads or 0)) or min(8, len(tasks)) or 1)
+    try:
+        list(pool.map(extract, tasks))
+    finally:
+        pool.shutdown()
+        updatafile.close()
+    return tasks
+
+def write_updata_manifest(manifest, entries, files):
+    ''' save what write_updata needs to rebuild the package of entries
+        (list_updata), files: the partition file names, relative to
+        manifest. gap is the zero bytes before a record.
+    '''
+    records = []
+    end = 0
+    for entry, path in zip(entries, files):
+        records.append(collections.OrderedDict((
+            ('position', '0x%x' % entry.position), ('file', path),
+            ('boardname', entry.boardname), ('date', entry.date),
+            ('time', entry.time), ('input', entry.input),
+            ('unknown', '0x%x' % entry.unknown), ('gap', entry.offset - end))))
+        end = entry.content_offset + entry.content_length
+        end += (~(entry.header_length + entry.content_length) + 1) & 3
+    output = open(manifest, 'w')
+    json.dump(records, output, indent=1)
+    output.close()
+
+def updata_crc_job(args):
+    # runs in a pool worker: the crc header of length bytes at offset of path
+    path, offset, length = args
+    source = open(path, 'rb')
+    source.seek(offset, 0)
+    crcs = crc_ccitt_blocks(source.read(length))
+    source.close()
+    return struct.pack('<%dH' % len(crcs), *[x ^ 0xffff for x in crcs])
+
+def write_updata(output, records, base='.', jobs=None):
+    ''' write UPDATA.APP to file object output, as parse_updata reads it.
+        records: [{'position', 'file', 'boardname', 'date', 'time',
+                   'input', 'unknown', 'gap'}, ...], as write_updata_manifest
+                 saves them, file relative to base
+        the crc headers are computed 64M at a time on a process pool of
+        jobs workers, content is copied 1M at a time.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    step = 64 << 20
+    field = lambda x, n: str(x).encode('latin')[:n]
+    value = lambda x: int(str(x), 0)
+    pool = ProcessPoolExecutor(int(str(jobs or 0)) or os.cpu_count() or 1)
+    try:
+        # queue every crc range first, the pool works ahead of the writer
+        pending = []
+        for record in records:
+            path = os.path.join(base, record['file'])
+            size = os.path.getsize(path)
+            pending.append((path, size, [pool.submit(updata_crc_job, (path, x, min(step, size - x)))
+                                         for x in range(0, size, step)]))
+
+        for record, (path, size, futures) in zip(records, pending):
+            crcs = b''.join(x.result() for x in futures)
+            header_length = UPDATA_HEADER.size + len(crcs)
+            output.write(bytes(int(record.get('gap', 0))))
+            output.write(UPDATA_HEADER.pack(b'\x55\xaa\x5a\xa5', header_length,
+                                            b'\x01\x00\x00\x00',
+                                            field(record.get('boardname', ''), 8),
+                                            value(record['position']), size,
+                                            field(record.get('date', ''), 16),
+                                            field(record.get('time', ''), 16),
+                                            field(record.get('input', 'INPUT'), 16),
+                                            b'', struct.pack('!H', value(record.get('unknown', 0))),
+                                            b'\x00\x10\x00\x00'))
+            output.write(crcs)
+            source = open(path, 'rb')
+            shutil.copyfileobj(source, output, 1 << 20)
+            source.close()
+            output.write(bytes((~(header_length + size) + 1) & 3))
+            sys.stderr.write('0x%x %d bytes <- %s\n' % (value(record['position']), size, path))
+    finally:
+        pool.shutdown()
+
+def repack_updata(manifest=None, out=None, jobs=None):
+    if manifest is None:
+        manifest = 'updata.json'
+    if out is None:
+        out = 'UPDATA-new.APP'
+    sys.stderr.write('arguments: [manifest] [out file] [jobs]\n')
+    sys.stderr.write('manifest: %s\n' % manifest)
+    sys.stderr.write('output: %s\n' % out)
+
+    records = json.load(open(manifest, 'r'))
+    output = open(out, 'wb')
+    write_updata(output, records, os.path.dirname(manifest), jobs)
+    output.close()
+
+def extract_updata_file(*args):
+    ''' arguments: [--only POS,POS] [--jobs N] [--output DIR] [--debug] [updata file] '''
+    only = None
+    jobs = None
+    outdir = '.'
+    debug = False
+    updata = 'UPDATA.APP'
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '--only':
+            only = set(int(x, 0) for x in args.pop(0).split(','))
+        elif arg == '--jobs':
+            jobs = int(args.pop(0))
+        elif arg == '--output':
+            outdir = args.pop(0)
+        elif arg == '--debug':
+            debug = True
+        else:
+            updata = arg
+    sys.stderr.write('arguments: [--only POS,POS] [--jobs N] [--output DIR] [--debug] [updata file]\n')
+    sys.stderr.write('updata file: %s\n' % updata)
+
+    begin = time.time()
+    tasks = extract_updata(updata, outdir, only, jobs, debug)
+    size = sum(x[0].content_length for x in tasks)
+    elapsed = max(time.time() - begin, 1e-6)
+    sys.stderr.write('%d partitions, %d bytes in %.3fs (%.1f MB/s)\n' % (len(tasks), size,
+                     elapsed, size / elapsed / 1e6))
+
+def verify_updata(updata=None):
+    ''' check the per 4K crc header of every partition of UPDATA.APP
+        against its content, without writing anything.
+    '''
+    if updata is None:
+        updata = 'UPDATA.APP'
+    sys.stderr.write('arguments: [updata file]\n')
+    sys.stderr.write('updata file: %s\n' % updata)
+
+    updatafile = open(updata, 'rb')
+    entries = list_updata(updatafile)
+    buf = map_file(updatafile)
+    bad = 0
+    size = 0
+    begin = time.time()
+    with memoryview(buf) as view:
+        for entry in entries:
+            header = view[entry.crc_offset:entry.content_offset]
+            content = view[entry.content_offset:entry.content_offset + entry.content_length]
+            errors = verify_crc_ccitt(header, content)
+            sys.stdout.write('0x%x %d bytes %d blocks %s\n' % (entry.position, entry.content_length,
+                             (entry.content_length + 4095) // 4096,
+                             errors and '%d bad, first at 0x%x' % (len(errors), errors[0] * 4096) or 'ok'))
+            bad += len(errors)
+            size += entry.content_length
+            header.release()
+            content.release()
+    if hasattr(buf, 'close'):
+        buf.close()
+    updatafile.close()
+
+    elapsed = max(time.time() - begin, 1e-6)
+    sys.stderr.write('%d bytes in %.3fs (%.1f MB/s)\n' % (size, elapsed, size / elapsed / 1e6))
+    if bad:
+        raise SystemExit('%d bad blocks' % bad)
 
 def unpack_updata(updata=None, debug=False):
     if updata is None and os.path.exists('UPDATA.APP'):
@@ -1468,26 +3345,70 @@ def unpack_updata(updata=None, debug=False):
     sys.stderr.write('output: system.img userdata.img (yaffs2 image)\n')
     parse_updata(open(updata, 'rb'), debug)
 
-def unpack_zte_bin(bin=None, debug=False):
-    if bin is None and os.path.exists('image.bin'):
-        bin = 'image.bin'
-    sys.stderr.write('arguments: [bin file]\n')
+def unpack_package(parse, index, bin, args):
+    ''' arguments: [--list] [--only NAME,NAME] [--jobs N] [--output DIR] [bin file] [debug] '''
+    listing = False
+    only = None
+    jobs = None
+    outdir = '.'
+    rest = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '--list':
+            listing = True
+        elif arg == '--only':
+            only = set(args.pop(0).split(','))
+        elif arg == '--jobs':
+            jobs = int(args.pop(0))
+        elif arg == '--output':
+            outdir = args.pop(0)
+        else:
+            rest.append(arg)
+    if rest:
+        bin = rest.pop(0)
+    debug = rest and rest[0] or False
+    sys.stderr.write('arguments: [--list] [--only NAME,NAME] [--jobs N] [--output DIR] [bin file] [debug]\n')
     sys.stderr.write('bin file: %s\n' % bin)
-    parse_zte_bin(open(bin, 'rb'), debug)
 
-def unpack_qsb(bin=None, debug=False):
-    if bin is None and os.path.exists('image.bin'):
+    binfile = open(bin, 'rb')
+    if listing:
+        for entry in index(binfile):
+            sys.stdout.write('0x%x %s %s 0x%x %d\n' % entry)
+        binfile.close()
+        return
+
+    begin = time.time()
+    tasks = parse(binfile, debug, outdir, only, jobs)
+    size = sum(x[0].size for x in tasks)
+    elapsed = max(time.time() - begin, 1e-6)
+    sys.stderr.write('%d partitions, %d bytes in %.3fs (%.1f MB/s)\n' % (len(tasks), size,
+                     elapsed, size / elapsed / 1e6))
+
+def unpack_zte_bin(*args):
+    bin = None
+    if os.path.exists('image.bin'):
         bin = 'image.bin'
-    sys.stderr.write('arguments: [bin file]\n')
-    sys.stderr.write('bin file: %s\n' % bin)
-    parse_qsb(open(bin, 'rb'), debug)
+    unpack_package(parse_zte_bin, list_zte_bin, bin, args)
 
-def repack_zte_bin(bin=None, debug=False):
+def unpack_qsb(*args):
+    bin = None
+    if os.path.exists('image.bin'):
+        bin = 'image.bin'
+    unpack_package(parse_qsb, list_qsb, bin, args)
+
+def repack_zte_bin(bin=None, debug=False, manifest=None):
     if bin is None:
         bin = 'image.bin'
-    sys.stderr.write('arguments: [bin file]\n')
+    sys.stderr.write('arguments: [bin file] [debug] [manifest]\n')
     sys.stderr.write('bin file: %s\n' % bin)
-    write_zte_bin(open(bin, 'wb'), debug)
+    files = None
+    base = '.'
+    if manifest is not None:
+        sys.stderr.write('manifest: %s\n' % manifest)
+        files = load_zte_bin_list(manifest)
+        base = os.path.dirname(manifest)
+    write_zte_bin(open(bin, 'wb'), debug, files, base)
 
 def to_ext4(img=None, outfile=None):
     if img is None and os.path.exists('system_ext4.img'):
@@ -1548,6 +3469,112 @@ def test_czlib(img=None, out=None):
     imgfile.close()
     outfile.close()
 
+def bench_padding(pages=None):
+    ''' time padding_size discovery on synthetic bootimgs whose kernel is
+        preceded by 1, 2, 4 ... pages zero pages, the old page-by-page
+        scan against find_bootimg_padding.
+    '''
+    if pages is None:
+        pages = 65536
+    pages = int(str(pages))
+    page_size = 0x800
+    kernel = b'\xff' * 0x10000
+    ramdisk = struct.pack('3B', 0x1f, 0x8b, 0x08) + bytes(0x1000)
+    sizes = (len(kernel), len(ramdisk), 0, 0)
+
+    def scan(bootimg):
+        bootimg.seek(page_size, 0)
+        while True:
+            if bootimg.read(page_size) == struct.pack('%ds' % page_size, b''):
+                continue
+            bootimg.seek(-page_size, 1)
+            return bootimg.tell()
+
+    sys.stderr.write('%10s %12s %12s\n' % ('zero pages', 'scan(ms)', 'header(ms)'))
+    gap = 1
+    while gap <= pages:
+        padding_size = gap * page_size
+        padding = lambda x: bytes((~x + 1) & (padding_size - 1))
+        header = BOOTIMG_HEADER.pack(b'ANDROID!', len(kernel), 0x10008000,
+            len(ramdisk), 0x11000000, 0, 0x10f00000, 0x10000100,
+            page_size, 0, 0, b'', b'', b'')
+        data = b''.join((header, bytes(padding_size - len(header)),
+                         kernel, padding(len(kernel)),
+                         ramdisk, padding(len(ramdisk))))
+
+        begin = time.time()
+        found1 = scan(io.BytesIO(data))
+        middle = time.time()
+        found2 = find_bootimg_padding(data, 0, page_size, sizes)
+        end = time.time()
+        assert found1 == found2 == padding_size, 'padding mismatch'
+
+        sys.stderr.write('%10d %12.3f %12.3f\n' % (gap - 1,
+                         (middle - begin) * 1000, (end - middle) * 1000))
+        gap <<= 1
+
+def bench_cpio(entries=None):
+    ''' time walking a synthetic cpio of entries small files, raw and
+        gzipped, with the old thirteen reads per header against iter_cpio.
+    '''
+    if entries is None:
+        entries = 5000
+    entries = int(str(entries))
+
+    def entry(ino, name, mode, data):
+        name = name.encode('latin') + b'\x00'
+        header = ('070701' + '%08x' * 13) % (ino, mode, 0, 0, 1, 0, len(data),
+                                              0, 0, 0, 0, len(name), 0)
+        return b''.join((header.encode('latin'), name, bytes((~(110 + len(name)) + 1) & 3),
+                         data, bytes((~len(data) + 1) & 3)))
+
+    chunks = [entry(0, 'sbin', 0o40755, b'')]
+    for ino in range(1, entries):
+        chunks.append(entry(ino, 'sbin/file%05d' % ino, 0o100644, b'x' * (ino % 700)))
+    chunks.append(entry(0, CPIO_TRAILER, 0, b''))
+    raw = b''.join(chunks)
+    compressed = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    gz = compressed.compress(raw) + compressed.flush()
+
+    def walk(cpio):
+        padding = lambda x: (~x + 1) & 3
+        names = []
+        while True:
+            assert cpio.read(6).decode('latin') == '070701', 'invalid cpio'
+            cpio.read(8)
+            mode = int(cpio.read(8), 16)
+            cpio.read(8)
+            cpio.read(8)
+            cpio.read(8)
+            cpio.read(8)
+            filesize = int(cpio.read(8), 16)
+            cpio.read(8)
+            cpio.read(8)
+            cpio.read(8)
+            cpio.read(8)
+            namesize = int(cpio.read(8), 16)
+            cpio.read(8)
+            name = cpio.read(namesize - 1).decode('latin')
+            cpio.read(1)
+            cpio.read(padding(namesize + 110))
+            if name == CPIO_TRAILER:
+                return names
+            cpio.read(filesize)
+            cpio.read(padding(filesize))
+            names.append(name)
+
+    sys.stderr.write('%8s %8s %12s %12s\n' % ('source', 'entries', 'old(ms)', 'new(ms)'))
+    for source, open_cpio in (('cpio', lambda: io.BytesIO(raw)),
+                              ('cpio.gz', lambda: GzipFile(fileobj=io.BytesIO(gz)))):
+        begin = time.time()
+        names1 = walk(open_cpio())
+        middle = time.time()
+        names2 = [x[0] for x in iter_cpio(open_cpio())]
+        end = time.time()
+        assert names1 == names2, 'entry mismatch'
+        sys.stderr.write('%8s %8d %12.3f %12.3f\n' % (source, len(names2),
+                         (middle - begin) * 1000, (end - middle) * 1000))
+
 def dcompress_mtk_logo(img=None, out_base=None):
     if img is None:
         sys.stderr.write('arguments: [img file [out file basename]]\n')
@@ -1875,6 +3902,10 @@ def add_head(img, out=None, mode=None, name=None):
     imginfofile.close()
     outfile.close()
 
+def pack_mtk_head(size, name):
+    return struct.pack('<II32s472s', 0x58881688, size,
+                       name.encode('latin'), b'\xff' * 472)
+
 def try_add_head(imgfile, outfile, imginfofile, mode=None, name=None):
     off2 = imginfofile.tell()
     imginfofile.seek(0, 0)
@@ -1891,7 +3922,6 @@ def try_add_head(imgfile, outfile, imginfofile, mode=None, name=None):
 
     if mode == 'mtk':
         sys.stderr.write('mtk mode\n')
-        magic = 0x58881688
         off1 = imgfile.tell()
         imgfile.seek(0, 2)
         size = imgfile.tell()
@@ -1905,8 +3935,7 @@ def try_add_head(imgfile, outfile, imginfofile, mode=None, name=None):
             if lines[0].strip() == 'mtk_header_name':
                 name = lines[1].strip()
                 break;
-        data = struct.pack('<II32s472s', magic, size, name, ''.ljust(472,'\xff'))
-        outfile.write(data)
+        outfile.write(pack_mtk_head(size, name))
 
         imgfile.seek(off1, 0)
         imginfofile.seek(off2, 0)
@@ -1915,7 +3944,7 @@ def try_add_head(imgfile, outfile, imginfofile, mode=None, name=None):
         #assert False, 'Unsupported mode.'
         return False
 
-def unpack_ramdisk(ramdisk=None, directory=None):
+def unpack_ramdisk(ramdisk=None, directory=None, threads=None):
     if ramdisk is None:
         if os.path.exists('ramdisk.gz'):
             ramdisk = 'ramdisk.gz'
@@ -1929,25 +3958,37 @@ def unpack_ramdisk(ramdisk=None, directory=None):
     if directory is None:
         directory = 'initrd'
 
-    sys.stderr.write('arguments: [ramdisk file] [directory]\n')
+    sys.stderr.write('arguments: [ramdisk file] [directory] [threads]\n')
     sys.stderr.write('ramdisk file: %s\n' % ramdisk)
     sys.stderr.write('directory: %s\n' % directory)
+    if threads is not None:
+        sys.stderr.write('threads: %s\n' % threads)
     sys.stderr.write('output: cpiolist.txt\n')
 
     if os.path.lexists(directory):
         raise SystemExit('please remove %s' % directory)
 
-    tmp = open(ramdisk, 'rb')
     cpiolist = open('cpiolist.txt', 'w')
+    cpio = open_ramdisk(open(ramdisk, 'rb'), cpiolist)
+    files = parse_cpio(cpio, directory, cpiolist, threads=threads)
+    write_ramdisk_manifest('cpiolist.manifest', ramdisk, 'cpiolist.txt', files)
+
+def open_ramdisk(tmp, cpiolist):
+    ''' return the cpio stream of ramdisk file object tmp, raw or any
+        of RAMDISK_FORMATS, decompressed on the fly as it is read.
+        mtk head, compress_level and compress_format are recorded in
+        cpiolist.
+    '''
     check_mtk_head(tmp, cpiolist)
     pos = tmp.tell()
 
     compress_level = 0
     magic = tmp.read(6)
-    if magic[:3] == struct.pack('3B', 0x1f, 0x8b, 0x08):
+    format = ramdisk_format(magic)
+    if format is not None:
         tmp.seek(pos, 0)
         compress_level = 6
-        cpio = CPIOGZIP(None, 'rb', compress_level, tmp)
+        cpio = format[2](tmp)
     elif magic.decode('latin') == '070701':
         tmp.seek(pos, 0)
         cpio = tmp
@@ -1956,9 +3997,95 @@ def unpack_ramdisk(ramdisk=None, directory=None):
         raise IOError('invalid ramdisk')
 
     cpiolist.write('compress_level:%d\n' % compress_level)
-    sys.stderr.write('compress: %s\n' % (compress_level > 0))
-    parse_cpio(cpio, directory, cpiolist)
+    if format is not None:
+        cpiolist.write('compress_format:%s\n' % format[0])
+    sys.stderr.write('compress: %s\n' % (format and format[0] or False))
+    return cpio
+
+# cpiolist options that change the bytes of a built ramdisk
+RAMDISK_BUILD_OPTIONS = ('mode', 'mtk_header_name', 'compress_level',
+                         'compress_threads', 'compress_format', 'cpio_dedup')
+
+def build_ramdisk(cpiolist):
+    ''' build the ramdisk described by cpiolist (file name) in memory.
+        compress_level and the mtk head are taken from cpiolist, a
+        compress_threads:N line there deflates on N threads instead of
+        one (0 for one per cpu). compress_format picks one of
+        RAMDISK_FORMATS, gzip by default. cpio_dedup:1 stores files with
+        the same content once, as hardlinks.
+        reproducible:1 orders the entries by path, so the output depends
+        on the listed content only. ramdisk_cache:<directory> keeps built
+        ramdisks in a SectionCache keyed by CpioList.digest, a hit skips
+        cpio generation and compression.
+        the original ramdisk is returned as is when nothing changed.
+        return bytes
+    '''
+    data = unchanged_ramdisk(cpiolist)
+    if data is not None:
+        sys.stderr.write('initrd unchanged, reusing the original ramdisk\n')
+        return data
+
+    entries = CpioList.load(cpiolist)
+    compress_level = int(entries.option('compress_level', '6'), 10)
+    compress_threads = int(entries.option('compress_threads', '1'), 10)
+    compress_format = entries.option('compress_format', 'gzip')
+    dedup = int(entries.option('cpio_dedup', '0'), 10)
+    if int(entries.option('reproducible', '0'), 10):
+        entries.sort()
+
+    cache = entries.option('ramdisk_cache')
+    if cache:
+        cache = SectionCache(cache)
+        key = 'ramdisk-%s' % entries.digest(RAMDISK_BUILD_OPTIONS)
+        scratch = tempfile.mkdtemp()
+        try:
+            if cache.get(key, scratch):
+                sys.stderr.write('ramdisk cache hit %s\n' % key)
+                return open(os.path.join(scratch, 'ramdisk'), 'rb').read()
+        finally:
+            shutil.rmtree(scratch, True)
+
+    class Output(io.BytesIO):
+        # write_cpio closes its output, keep the data around
+        def close(self):
+            pass
+
+    tmp = Output()
+    if compress_level <= 0:
+        cpiogz = tmp
+    else:
+        if compress_level > 9:
+            compress_level = 9
+        formats = dict((x[0], x) for x in RAMDISK_FORMATS)
+        assert compress_format in formats, 'unknown compress_format %s' % compress_format
+        if compress_format == 'gzip' and compress_threads != 1:
+            cpiogz = ParallelCPIOGZIP(tmp, compress_level, compress_threads)
+            sys.stderr.write('compress_threads: %d\n' % cpiogz.threads)
+        else:
+            cpiogz = formats[compress_format][3](tmp, compress_level)
+        sys.stderr.write('compress_format: %s\n' % compress_format)
+    sys.stderr.write('compress_level: %d\n' % compress_level)
+    write_cpio(entries, cpiogz, dedup)
+
+    out = io.BytesIO()
+    info = open(cpiolist, 'r')
+    if try_add_head(tmp, out, info):
+        out.write(tmp.getvalue())
+        data = out.getvalue()
+    else:
+        data = tmp.getvalue()
+    info.close()
 
+    if cache:
+        scratch = tempfile.mkdtemp()
+        try:
+            output = open(os.path.join(scratch, 'ramdisk'), 'wb')
+            output.write(data)
+            output.close()
+            cache.put(key, scratch, ['ramdisk'])
+        finally:
+            shutil.rmtree(scratch, True)
+    return data
 
 def repack_ramdisk(cpiolist=None):
     if cpiolist is None:
@@ -1968,53 +4095,168 @@ def repack_ramdisk(cpiolist=None):
     sys.stderr.write('cpiolist file: %s\n' % cpiolist)
     sys.stderr.write('output: ramdisk.cpio.gz\n')
 
-    tmp = open('ramdisk.cpio.gz.tmp', 'wb')
+    data = build_ramdisk(cpiolist)
     out = open('ramdisk.cpio.gz', 'wb')
-    cpiogz = tmp
-    
-    info = open(cpiolist, 'r')
-    compress_level = 6
-    
-    off2 = info.tell()
-    info.seek(0, 0)
-    for line in info.readlines():
-        lines = line.split(':')
-        if len(lines) < 1 or lines[0][0] == '#':
-            continue;
-        if lines[0].strip() == 'compress_level':
-            compress_level = int(lines[1], 10)
-            break
-    info.seek(off2, 0)
+    out.write(data)
+    out.close()
+
+def load_ramdisk_patch(patch):
+    ''' read the patch set for edit_ramdisk from patch, a directory whose
+        tree is laid over the ramdisk, or a manifest of cpiolist style
+        lines:
+            file name path mode    add or replace name with path
+            dir name mode
+            slink name target mode
+            delete name
+            chmod name mode
+        a mode of - keeps the mode of the entry being replaced.
+        return OrderedDict name -> [action, args ...]
+    '''
+    patches = collections.OrderedDict()
+    if os.path.isdir(patch):
+        for root, dirs, files in os.walk(patch):
+            dirs.sort()
+            for item in dirs + sorted(files):
+                path = os.path.join(root, item)
+                name = os.path.relpath(path, patch).replace(os.sep, '/')
+                if os.path.islink(path):
+                    patches[name] = ['slink', os.readlink(path), '-']
+                elif os.path.isdir(path):
+                    patches[name] = ['dir', '-']
+                else:
+                    patches[name] = ['file', path, '-']
+        return patches
 
-    if compress_level <= 0:
-        cpiogz = tmp
-    else:
-        if compress_level > 9:
-            compress_level = 9
-        cpiogz = CPIOGZIP(None, 'wb', compress_level, tmp)
-    sys.stderr.write('compress_level: %d\n' % compress_level)
-    write_cpio(info, cpiogz)
-    #cpiogz.close()
-    tmp.close()
-    #info.close()
+    manifest = open(patch, 'r')
+    for line in manifest:
+        lines = line.split()
+        if len(lines) < 2 or lines[0][0] == '#':
+            continue
+        action, name = lines[0], os.path.normpath(lines[1].lstrip('/'))
+        assert action in ('file', 'dir', 'slink', 'delete', 'chmod'), \
+            'unknown action %s' % action
+        patches[name.replace(os.sep, '/')] = [action] + lines[2:]
+    manifest.close()
+    return patches
+
+def edit_ramdisk(ramdisk, patches):
+    ''' apply patches (see load_ramdisk_patch) to ramdisk, bytes-like raw
+        cpio or any of RAMDISK_FORMATS with or without mtk head. entries
+        are streamed from the old archive to the new one, which keeps the
+        compression and head of the old one, nothing is extracted.
+        entries not in the old archive are appended before the trailer.
+        return bytes
+    '''
+    patches = collections.OrderedDict(patches)
+    info = io.StringIO()
+    with memoryview(ramdisk) as view:
+        cpio = open_ramdisk(BufferReader(view), info)
+        options = CpioList.parse(io.StringIO(info.getvalue())).options
+        compress_level = int(options.get('compress_level', '0'), 10)
+        compress_format = options.get('compress_format')
+
+        class Output(io.BytesIO):
+            def close(self):
+                pass
 
-    tmp = open('ramdisk.cpio.gz.tmp', 'rb')
-    info = open(cpiolist, 'r')
+        tmp = Output()
+        output = tmp
+        if compress_level > 0:
+            formats = dict((x[0], x) for x in RAMDISK_FORMATS)
+            output = formats[compress_format][3](tmp, compress_level)
+
+        state = {'ino': 300000, 'size': 0}
+        def write_entry(name, mode, data=b'', path=None):
+            if path is not None:
+                filesize = os.path.getsize(path)
+            else:
+                filesize = len(data)
+            header = cpio_header(state['ino'], name, mode, filesize)
+            output.write(header)
+            if path is not None:
+                source = open(path, 'rb')
+                shutil.copyfileobj(source, output, 1 << 20)
+                source.close()
+            else:
+                output.write(data)
+            tail = bytes((~filesize + 1) & 3)
+            output.write(tail)
+            state['ino'] += 1
+            state['size'] += len(header) + filesize + len(tail)
+
+        def apply(name, mode, data, patch):
+            ''' write name patched, mode and data are None for new ones. '''
+            action, args = patch[0], patch[1:] + ['-'] * 2
+            def perm(value, default):
+                if value != '-':
+                    return int(value, 8)
+                return S_IMODE(mode) if mode is not None else default
+
+            sys.stderr.write('%s %s\n' % (action, name))
+            if action == 'chmod':
+                write_entry(name, S_IFMT(mode) | int(args[0], 8), data)
+            elif action == 'file':
+                write_entry(name, S_IFREG | perm(args[1], 0o644), path=args[0])
+            elif action == 'dir':
+                write_entry(name, S_IFDIR | perm(args[0], 0o755))
+            elif action == 'slink':
+                write_entry(name, S_IFLNK | perm(args[1], 0o777), args[0].encode('latin'))
+
+        for name, mode, data in iter_cpio(cpio):
+            key = os.path.normpath(name.lstrip('/')).replace(os.sep, '/')
+            patch = patches.pop(key, None)
+            if patch is None:
+                write_entry(name, mode, data)
+            else:
+                apply(name, mode, data, patch)
+        for name, patch in patches.items():
+            if patch[0] in ('delete', 'chmod'):
+                sys.stderr.write('%s not found, skip %s\n' % (name, patch[0]))
+                continue
+            apply(name, None, None, patch)
+
+        write_entry(CPIO_TRAILER, 0o644)
+        # normally, padding is ignored by decompresser
+        output.write(bytes((~state['size'] + 1) & 511))
+        output.close()
+        cpio.close()
+
+    out = io.BytesIO()
     if try_add_head(tmp, out, info):
-        while True:
-            data = tmp.read(65536)
-            if not data:
-                break
-            out.write(data)
-        tmp.close()
-        out.close()
-        os.remove('ramdisk.cpio.gz.tmp')
+        out.write(tmp.getvalue())
+        return out.getvalue()
+    return tmp.getvalue()
+
+def edit_ramdisk_file(ramdisk=None, patch=None, out=None):
+    if ramdisk is None or patch is None:
+        sys.stderr.write('arguments: ramdisk|bootimg patch [out file]\n')
+        sys.stderr.write('patch: overlay directory or manifest file\n')
+        return
+    if out is None:
+        out = ramdisk
+    sys.stderr.write('ramdisk file: %s\n' % ramdisk)
+    sys.stderr.write('patch: %s\n' % patch)
+    sys.stderr.write('output: %s\n' % out)
+
+    patches = load_ramdisk_patch(patch)
+    source = open(ramdisk, 'rb')
+    buf = map_file(source)
+    if b'ANDROID!' in (bytes(buf[:8]), bytes(buf[0x200:0x208])):
+        img = BootImage.load(buf)
+        img.replace('ramdisk', edit_ramdisk(img.sections['ramdisk'], patches))
+        data = io.BytesIO()
+        img.write(data)
+        img.close()
+        data = data.getvalue()
     else:
-        tmp.close()
-        out.close()
-        os.remove('ramdisk.cpio.gz')
-        os.rename('ramdisk.cpio.gz.tmp', 'ramdisk.cpio.gz')
-    info.close()
+        data = edit_ramdisk(buf, patches)
+    if hasattr(buf, 'close'):
+        buf.close()
+    source.close()
+
+    output = open(out, 'wb')
+    output.write(data)
+    output.close()
 
 def unpack_yaffs(image=None, directory=None):
     if image is None:
@@ -2158,9 +4400,17 @@ if __name__ == '__main__':
 
     functions = {
                  '--unpack-updata': unpack_updata,
+                 '--verify-updata': verify_updata,
+                 '--list-updata': list_updata_file,
+                 '--extract-updata': extract_updata_file,
+                 '--repack-updata': repack_updata,
                  '--unpack-zte-bin': unpack_zte_bin,
                  '--unpack-qsb': unpack_qsb,
                  '--unpack-bootimg': unpack_bootimg,
+                 '--extract-section': extract_bootimg_section,
+                 '--analyze-kernel': analyze_kernel_file,
+                 '--unpack-batch': unpack_batch,
+                 '--cache-stats': cache_stats,
                  '--remove-head': remove_head,
 				 '--unpack-ramdisk': unpack_ramdisk,
                  '--unpack-yaffs': unpack_yaffs,
@@ -2172,12 +4422,15 @@ if __name__ == '__main__':
                  '--to-img': to_img,
                  '--dzlib': test_dzlib,
                  '--czlib': test_czlib,
+                 '--bench-padding': bench_padding,
+                 '--bench-cpio': bench_cpio,
                  '--dml': dcompress_mtk_logo,
                  '--cml': compress_mtk_logo,
                  '--uml': unpack_mali_logo,
                  '--rml': repack_mali_logo,
                  '--repack-zte-bin': repack_zte_bin,
                  '--repack-ramdisk': repack_ramdisk,
+                 '--edit-ramdisk': edit_ramdisk_file,
                  '--repack-bootimg': repack_bootimg,
                  '--add-head': add_head,
                  '--repack-rle': repack_rle,
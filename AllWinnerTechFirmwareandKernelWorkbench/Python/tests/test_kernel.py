@@ -0,0 +1,94 @@
+import gzip
+import os
+import struct
+import sys
+import types
+import zlib
+
+import pytest
+
+import boot3
+
+BANNER = b'Linux version 4.9.0 (builder@host) #1 SMP\n\x00'
+
+
+def image(size=300000):
+    # an uncompressed kernel with its version banner somewhere inside
+    data = bytearray(os.urandom(size))
+    data[size // 2:size // 2 + len(BANNER)] = BANNER
+    return bytes(data)
+
+
+def zimage(payload):
+    # decompressor stub, then the payload, then the appended dtb
+    return b'\x00' * 0x200 + payload + b'\xd0\x0d\xfe\xed' + b'\x00' * 64
+
+
+def lzop(data, block=0x10000):
+    # lzop -c with every block stored, flags adler32 of the data
+    header = struct.pack('>HHHBBIIIIB', 0x1030, 0x2080, 0x0940, 1, 5, 1, 0o100644, 0, 0, 0)
+    out = boot3.LzopDecompressor.MAGIC + header + struct.pack('>I', zlib.adler32(header))
+    for pos in range(0, len(data), block):
+        chunk = data[pos:pos + block]
+        out += struct.pack('>III', len(chunk), len(chunk), zlib.adler32(chunk)) + chunk
+    return out + b'\x00' * 4
+
+
+def test_gzip_payload_is_streamed(tmp_path):
+    kernel = image()
+    out = tmp_path / 'Image'
+    with open(out, 'wb') as output:
+        report = boot3.analyze_kernel(zimage(gzip.compress(kernel)), output, probe_size=4096)
+    assert report['compression'] == 'gzip'
+    assert report['offset'] == 0x200
+    assert report['size'] == len(kernel)
+    assert report['version'] == BANNER.rstrip(b'\n\x00').decode()
+    assert out.read_bytes() == kernel
+
+
+def test_truncated_payload_leaves_no_output(tmp_path):
+    kernel = image()
+    data = zimage(gzip.compress(kernel)[:-5000])
+    src = tmp_path / 'zImage'
+    src.write_bytes(data)
+    out = tmp_path / 'Image'
+    with pytest.raises(SystemExit):
+        boot3.analyze_kernel_file(str(src), str(out))
+    assert not out.exists()
+
+
+def test_zstd_payload():
+    zstandard = pytest.importorskip('zstandard')
+    kernel = image()
+    payload = zstandard.ZstdCompressor().compress(kernel)
+    report = boot3.analyze_kernel(zimage(payload))
+    assert report['compression'] == 'zstd'
+    assert report['compressed_size'] == len(payload)
+    assert report['size'] == len(kernel)
+
+
+def test_lzo_payload(monkeypatch):
+    # stored blocks only, python-lzo is imported but never called
+    monkeypatch.setitem(sys.modules, 'lzo', types.SimpleNamespace(error=Exception))
+    kernel = image()
+    payload = lzop(kernel)
+    report = boot3.analyze_kernel(zimage(payload))
+    assert report['compression'] == 'lzo'
+    assert report['compressed_size'] == len(payload)
+    assert report['size'] == len(kernel)
+
+
+def test_missing_module_is_an_error(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'lzo', None)
+    with pytest.raises(SystemExit) as error:
+        boot3.analyze_kernel(zimage(lzop(image())))
+    assert 'python-lzo' in str(error.value)
+
+
+def test_bootimg_without_kernel(tmp_path):
+    src = tmp_path / 'boot.img'
+    src.write_bytes(b'ANDROID!' + b'\x00' * 4096)
+    with pytest.raises(SystemExit) as error:
+        boot3.analyze_kernel_file(str(src), str(tmp_path / 'Image'))
+    assert 'no kernel' in str(error.value)
+    assert not (tmp_path / 'Image').exists()